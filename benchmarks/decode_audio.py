@@ -0,0 +1,109 @@
+"""
+Decode benchmark for transcribe_audio.
+
+Times the old path (pydub mp3 -> transcript.wav -> sr.AudioFile) against the
+in-memory ffmpeg pipe used by cli.py, up to the FLAC payload that
+recognize_google sends, for every mp3 in a folder.
+"""
+# run from the repo root: python benchmarks/decode_audio.py --generate 10
+# or against real audio: python benchmarks/decode_audio.py -i transcribe_audio/input_audios
+
+import os
+import sys
+import argparse
+import importlib.util
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_stage(stage):
+    spec = importlib.util.spec_from_file_location(stage, os.path.join(root, stage, "cli.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_audio(folder, count, seconds):
+    # Stereo 44.1 kHz test tones, the same layout as most recorded mp3s
+    import ffmpeg
+
+    for i in range(count):
+        path = os.path.join(folder, f"tone{i}.mp3")
+        if not os.path.exists(path):
+            (
+                ffmpeg.input(f"sine=frequency={220 + 20 * i}:duration={seconds}", f="lavfi")
+                .output(path, ac=2, ar=44100)
+                .run(quiet=True)
+            )
+
+
+def decode_wav(path, wav_path):
+    import speech_recognition as sr
+    from pydub import AudioSegment
+
+    AudioSegment.from_mp3(path).export(wav_path, format="wav")
+    with sr.AudioFile(wav_path) as source:
+        return sr.Recognizer().record(source)
+
+
+def load_pcm(cli, path):
+    import speech_recognition as sr
+
+    return sr.AudioData(b"".join(cli.decode_pcm(path)), cli.SAMPLE_RATE, cli.SAMPLE_WIDTH)
+
+
+def flac_payload(audio):
+    # Same conversion recognize_google does before posting the audio
+    return audio.get_flac_data(convert_rate=None if audio.sample_rate >= 8000 else 8000, convert_width=2)
+
+
+def run(name, decode, paths):
+    decode_time = 0
+    flac_time = 0
+    flac_bytes = 0
+    for path in paths:
+        start = time.perf_counter()
+        audio = decode(path)
+        decode_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        flac_bytes += len(flac_payload(audio))
+        flac_time += time.perf_counter() - start
+
+    print(f"{name:<6} decode {decode_time:.2f}s  flac {flac_time:.2f}s  "
+          f"total {(decode_time + flac_time) / len(paths) * 1000:.0f} ms/file  "
+          f"payload {flac_bytes / len(paths) / 1024:.0f} KB/file")
+
+
+def main(args=None):
+    folder = args.input or tempfile.mkdtemp(prefix="decode_audio_")
+    if args.generate:
+        os.makedirs(folder, exist_ok=True)
+        generate_audio(folder, args.generate, args.seconds)
+
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".mp3"))
+    if not paths:
+        print(f"No mp3 files in {folder}, use --generate")
+        return 1
+    print(f"Decoding {len(paths)} files from {folder}")
+
+    cli = load_stage("transcribe_audio")
+    with tempfile.TemporaryDirectory() as work_dir:
+        wav_path = os.path.join(work_dir, "transcript.wav")
+        run("wav", lambda path: decode_wav(path, wav_path), paths)
+    run("pipe", lambda path: load_pcm(cli, path), paths)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare mp3 decode paths for transcribe_audio")
+
+    parser.add_argument("-i", "--input", help="Folder of mp3 files (default: a temporary folder)")
+    parser.add_argument("--generate", type=int, default=0, help="Create this many test tones in the folder first")
+    parser.add_argument("--seconds", type=int, default=30, help="Length of each generated tone")
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
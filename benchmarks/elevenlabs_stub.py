@@ -0,0 +1,134 @@
+"""
+Local stand-in for the ElevenLabs text to speech streaming endpoint.
+
+Answers POST /v1/text-to-speech/{voice_id}/stream with silent mp3 frames,
+about as much audio as reading the text aloud would take, streamed out at a
+configurable speed after a first-byte latency that can grow with load. Requests beyond the
+concurrency limit get the same 429 the real API sends and --error-rate of the
+others fail with a 500, so synthesis_audio can be exercised without an API key.
+"""
+# python benchmarks/elevenlabs_stub.py --port 8081 --concurrency 4
+# export ELEVENLABS_BASE_URL=http://localhost:8081 XI_API_KEY=stub ; python cli.py -s -c 8
+
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, mono: 417 byte frames of 1152 samples.
+# With all side info zeroed each frame decodes to silence
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0xC4])
+FRAME_BYTES = 417
+FRAME_SECONDS = 1152 / 44100
+FRAME = FRAME_HEADER + bytes(FRAME_BYTES - len(FRAME_HEADER))
+
+# Speaking rate used to size the audio for a text
+CHARACTERS_PER_SECOND = 15
+
+
+def make_handler(args, stats):
+    in_flight = threading.BoundedSemaphore(args.concurrency)
+    active = [0]
+    active_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            parts = self.path.strip("/").split("/")
+
+            if len(parts) != 4 or parts[:2] != ["v1", "text-to-speech"] or parts[3] != "stream":
+                self.send_json(404, {"detail": {"status": "not_found", "message": f"Unknown path {self.path}"}})
+                return
+            if not self.headers.get("xi-api-key"):
+                self.send_json(401, {"detail": {"status": "invalid_api_key", "message": "Missing xi-api-key"}})
+                return
+            if not in_flight.acquire(blocking=False):
+                stats["rate_limited"] += 1
+                self.send_json(429, {"detail": {"status": "too_many_concurrent_requests",
+                                                "message": "Too many concurrent requests"}})
+                return
+
+            if random.random() < args.error_rate:
+                in_flight.release()
+                stats["errors"] += 1
+                self.send_json(500, {"detail": {"status": "internal_error", "message": "Stub failure"}})
+                return
+
+            with active_lock:
+                active[0] += 1
+                latency = args.latency + args.load_latency * (active[0] - 1)
+            try:
+                self.send_audio(body.get("text", ""), latency)
+            finally:
+                with active_lock:
+                    active[0] -= 1
+                in_flight.release()
+
+        def send_audio(self, text, latency):
+            frames = max(int(len(text) / CHARACTERS_PER_SECOND / FRAME_SECONDS), 1)
+            stats["completed"] += 1
+            stats["characters"] += len(text)
+
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            # Generated args.speed times faster than real time, in chunks of about 100 ms of audio
+            frames_per_chunk = max(int(0.1 / FRAME_SECONDS), 1)
+            for start in range(0, frames, frames_per_chunk):
+                count = min(frames_per_chunk, frames - start)
+                time.sleep(count * FRAME_SECONDS / args.speed)
+                chunk = FRAME * count
+                self.wfile.write(f"{len(chunk):X}\r\n".encode("ascii") + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def main(args=None):
+    stats = {"completed": 0, "rate_limited": 0, "errors": 0, "characters": 0}
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args, stats))
+    print(f"ElevenLabs stub listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Completed {stats['completed']} requests ({stats['characters']} characters), "
+          f"rate limited {stats['rate_limited']}, failed {stats['errors']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the ElevenLabs text to speech API")
+
+    parser.add_argument("-p", "--port", type=int, default=8081, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds before the first byte")
+    parser.add_argument("--load-latency", type=float, default=0.0,
+                        help="Seconds added to the first-byte latency for every other request in flight")
+    parser.add_argument("--speed", type=float, default=20.0, help="Audio generated per second, as a multiple of real time")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent requests allowed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a 500")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+
+    args = parser.parse_args()
+
+    main(args)
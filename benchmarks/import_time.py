@@ -0,0 +1,106 @@
+"""
+Startup benchmark for the stage CLIs.
+
+Runs `python cli.py --help` for every stage without any credentials in the
+environment and fails if startup is slow or if any heavy dependency gets
+imported before a step actually needs it.
+"""
+# run from the repo root: python benchmarks/import_time.py
+
+import os
+import sys
+import argparse
+import subprocess
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+stages = [
+    "transcribe_audio",
+    "generate_text",
+    "synthesis_audio",
+    "synthesis_audio_en",
+    "translate_text",
+]
+
+# Modules that must only be imported by the steps that use them
+heavy_modules = [
+    "boto3",
+    "botocore",
+    "openai",
+    "numpy",
+    "requests",
+    "speech_recognition",
+    "pydub",
+    "ffmpeg",
+    "transformers",
+    "torch",
+]
+
+
+def run_help(stage):
+    # -X importtime reports every module imported at startup on stderr
+    env = {key: value for key, value in os.environ.items()
+           if key not in ("AWS_APPLICATION_CREDENTIALS", "OPENAI_API_KEY_FILE")}
+    start_time = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "cli.py", "--help"],
+        cwd=os.path.join(root, stage),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"{stage}: cli.py --help failed\n{result.stderr}")
+
+    imported = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            imported.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return elapsed, imported
+
+
+def main(args=None):
+    failed = False
+    for stage in stages:
+        timings = []
+        for _ in range(args.repeat):
+            elapsed, imported = run_help(stage)
+            timings.append(elapsed)
+        best = min(timings)
+
+        eager = sorted(imported.intersection(heavy_modules))
+        status = "ok"
+        if eager or best > args.budget:
+            status = "FAIL"
+            failed = True
+        print(f"{stage:20s} {best * 1000:8.1f} ms  {status}"
+              + (f"  eager imports: {', '.join(eager)}" if eager else ""))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark stage CLI startup time")
+
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of runs per stage, the fastest one is reported",
+    )
+
+    parser.add_argument(
+        "-b",
+        "--budget",
+        type=float,
+        default=0.5,
+        help="Maximum allowed startup time in seconds",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
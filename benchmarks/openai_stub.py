@@ -0,0 +1,310 @@
+"""
+Local stand-in for the OpenAI chat completions, files and batches endpoints.
+
+Answers POST /v1/chat/completions after a configurable latency, enforces
+requests- and tokens-per-minute limits the same way the real API does
+(429 with retry-after-ms once a bucket is empty) and returns the
+x-ratelimit-* headers, so generate_text can be exercised without an API key.
+Batches uploaded through /v1/files and /v1/batches complete --batch-delay
+seconds after submission.
+"""
+# python benchmarks/openai_stub.py --port 8080 --rpm 60 --tpm 40000
+# export OPENAI_BASE_URL=http://localhost:8080/v1 ; python cli.py -g -c 8
+# python cli.py --batch --poll-interval 5
+
+import json
+import time
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Limits:
+    # Requests and tokens replenish continuously at limit/60 per second, like
+    # the real API, shared by all handler threads
+    def __init__(self, rpm, tpm):
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.available = {"requests": float(rpm), "tokens": float(tpm)}
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, tokens):
+        with self.lock:
+            now = time.monotonic()
+            for name, limit in self.limits.items():
+                self.available[name] = min(limit, self.available[name] + (now - self.updated) * limit / 60)
+            self.updated = now
+
+            cost = {"requests": 1, "tokens": tokens}
+            allowed = all(self.available[name] >= cost[name] for name in cost)
+            if allowed:
+                for name in cost:
+                    self.available[name] -= cost[name]
+
+            # Seconds until the scarcest bucket can serve this request again
+            wait = max((cost[name] - self.available[name]) * 60 / self.limits[name] for name in cost)
+            headers = {}
+            for name, limit in self.limits.items():
+                headers[f"x-ratelimit-limit-{name}"] = str(limit)
+                headers[f"x-ratelimit-remaining-{name}"] = str(int(self.available[name]))
+                headers[f"x-ratelimit-reset-{name}"] = f"{(limit - self.available[name]) * 60 / limit:.3f}s"
+            return allowed, max(wait, 0), headers
+
+
+def completion_text(prompt, words):
+    # Random words from the prompt, with a sentence end every dozen words or so
+    vocabulary = [word.strip(".!?") for word in prompt.split()] or ["cheese"]
+    text = []
+    for i in range(words):
+        text.append(random.choice(vocabulary))
+        if i % 12 == 11:
+            text[-1] += "."
+    return " ".join(text).rstrip(".") + "."
+
+
+def completion_body(body, words, completion_id):
+    prompt = " ".join(message["content"] for message in body.get("messages", []))
+    prompt_tokens = len(prompt) // 4
+    completion_tokens = min(body.get("max_tokens") or 700, words)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": completion_text(prompt, completion_tokens)},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class BatchStore:
+    # Uploaded files and submitted batches, kept in memory for the life of the server
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+
+    def add_file(self, content, filename, purpose):
+        with self.lock:
+            file_id = f"file-stub-{len(self.files) + 1}"
+            self.files[file_id] = {
+                "meta": {
+                    "id": file_id,
+                    "object": "file",
+                    "bytes": len(content),
+                    "created_at": int(time.time()),
+                    "filename": filename,
+                    "purpose": purpose,
+                    "status": "processed",
+                },
+                "content": content,
+            }
+            return self.files[file_id]["meta"]
+
+    def add_batch(self, input_file_id, endpoint, completion_window):
+        with self.lock:
+            batch_id = f"batch-stub-{len(self.batches) + 1}"
+            lines = [line for line in self.files[input_file_id]["content"].splitlines() if line.strip()]
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": endpoint,
+                "input_file_id": input_file_id,
+                "completion_window": completion_window,
+                "status": "in_progress",
+                "created_at": int(time.time()),
+                "output_file_id": None,
+                "error_file_id": None,
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            }
+            return self.batches[batch_id]
+
+    def get_batch(self, batch_id):
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= self.args.batch_delay:
+                self.run(batch)
+            return batch
+
+    def run(self, batch):
+        output = []
+        for line in self.files[batch["input_file_id"]]["content"].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            output.append(json.dumps({
+                "id": f"batch-req-{len(output) + 1}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": f"req-{len(output) + 1}",
+                    "body": completion_body(request["body"], self.args.words, f"chatcmpl-batch-{len(output) + 1}"),
+                },
+                "error": None,
+            }))
+
+        content = ("\n".join(output) + "\n").encode("utf-8")
+        file_id = f"file-stub-{len(self.files) + 1}"
+        self.files[file_id] = {
+            "meta": {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                     "filename": "batch_output.jsonl", "purpose": "batch_output", "status": "processed"},
+            "content": content,
+        }
+        batch["output_file_id"] = file_id
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"]["completed"] = len(output)
+
+
+def make_handler(args, limits, stats, store):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            if path.startswith("/v1/batches/") and path.split("/")[-1] in store.batches:
+                self.send_json(200, store.get_batch(path.split("/")[-1]))
+            elif path.startswith("/v1/files/") and path.endswith("/content") and path.split("/")[-2] in store.files:
+                content = store.files[path.split("/")[-2]]["content"]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def upload_file(self, raw_body):
+            # Parse the multipart/form-data body of a file upload
+            message = BytesParser().parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + raw_body)
+            fields = {}
+            for part in message.get_payload():
+                fields[part.get_param("name", header="content-disposition")] = part
+            file_part = fields["file"]
+            meta = store.add_file(file_part.get_payload(decode=True),
+                                  file_part.get_filename() or "upload.jsonl",
+                                  fields["purpose"].get_payload(decode=True).decode("utf-8"))
+            self.send_json(200, meta)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw_body = self.rfile.read(length)
+            path = self.path.rstrip("/")
+
+            if path == "/v1/files":
+                self.upload_file(raw_body)
+                return
+
+            body = json.loads(raw_body or b"{}")
+
+            if path == "/v1/batches":
+                if body.get("input_file_id") not in store.files:
+                    self.send_json(400, {"error": {"message": "Unknown input_file_id"}})
+                    return
+                self.send_json(200, store.add_batch(body["input_file_id"], body.get("endpoint"),
+                                                    body.get("completion_window", "24h")))
+                return
+
+            if path != "/v1/chat/completions":
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+
+            prompt = " ".join(message["content"] for message in body.get("messages", []))
+            prompt_tokens = len(prompt) // 4
+            max_tokens = body.get("max_tokens") or 700
+            allowed, reset, headers = limits.take(prompt_tokens + max_tokens)
+            if not allowed:
+                stats["rate_limited"] += 1
+                headers["retry-after-ms"] = f"{reset * 1000:.0f}"
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                               "code": "rate_limit_exceeded"}}, headers)
+                return
+
+            stats["completed"] += 1
+            completion = completion_body(body, args.words, f"chatcmpl-stub-{stats['completed']}")
+
+            if body.get("stream"):
+                self.send_stream(completion, headers)
+                return
+
+            time.sleep(args.latency)
+            self.send_json(200, completion, headers)
+
+        def send_stream(self, completion, headers):
+            # Server-sent events, one chunk per word spread over the configured latency
+            words = completion["choices"][0]["message"]["content"].split(" ")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            for i, word in enumerate(words):
+                time.sleep(args.latency / len(words))
+                chunk = {
+                    "id": completion["id"],
+                    "object": "chat.completion.chunk",
+                    "created": completion["created"],
+                    "model": completion["model"],
+                    "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word},
+                                 "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            done = dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            self.wfile.write(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+def main(args=None):
+    limits = Limits(args.rpm, args.tpm)
+    stats = {"completed": 0, "rate_limited": 0}
+    store = BatchStore(args)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args, limits, stats, store))
+    print(f"OpenAI stub listening on http://127.0.0.1:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Completed {stats['completed']} requests, rate limited {stats['rate_limited']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI API")
+
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=2.0, help="Seconds spent on each completion")
+    parser.add_argument("--words", type=int, default=200, help="Words in each completion")
+    parser.add_argument("--rpm", type=int, default=60, help="Requests per minute limit")
+    parser.add_argument("--tpm", type=int, default=40000, help="Tokens per minute limit")
+    parser.add_argument("--batch-delay", type=float, default=30.0, help="Seconds before a batch completes")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+
+    args = parser.parse_args()
+
+    main(args)
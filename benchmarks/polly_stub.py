@@ -0,0 +1,260 @@
+"""
+Local stand-in for the Amazon Polly API.
+
+Serves SynthesizeSpeech and the asynchronous synthesis task calls
+(StartSpeechSynthesisTask, GetSpeechSynthesisTask, ListSpeechSynthesisTasks)
+with silent mp3 frames about as long as reading the text aloud. SSML <mark>
+and <break> tags are honoured and OutputFormat json returns ssml speech marks
+at the frame the mark falls on. Requests above
+--rps per second are refused with ThrottlingException. Tasks finish
+after --task-delay seconds and write their output to an S3 endpoint such as
+moto_server, so synthesis_audio_en can be exercised without AWS.
+"""
+# moto_server -p 5000 &
+# python benchmarks/polly_stub.py --port 8082 --s3-endpoint http://localhost:5000
+# export AWS_ENDPOINT_URL_POLLY=http://localhost:8082 AWS_ENDPOINT_URL_S3=http://localhost:5000
+# python cli.py -s
+
+import re
+import html
+import json
+import time
+import uuid
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, mono: 417 byte frames of 1152 samples.
+# With all side info zeroed each frame decodes to silence
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0xC4])
+FRAME_BYTES = 417
+FRAME_SECONDS = 1152 / 44100
+FRAME = FRAME_HEADER + bytes(FRAME_BYTES - len(FRAME_HEADER))
+
+# Speaking rate used to size the audio for a text
+CHARACTERS_PER_SECOND = 15
+
+# synthesize_speech limits on billed characters and on the whole text, SSML tags included
+SYNC_MAX_CHARS = 3000
+SSML_MAX_CHARS = 6000
+
+ssml_token = re.compile(r'<mark\s+name="([^"]*)"\s*/>|<break\s+time="(\d+)ms"\s*/>|<[^>]*>|([^<]+)')
+
+
+class RateLimit:
+    # Token bucket of --rps requests per second with a one second burst, shared by
+    # all handler threads
+    def __init__(self, rps):
+        self.rps = rps
+        self.available = float(rps)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if not self.rps:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.rps, self.available + (now - self.updated) * self.rps)
+            self.updated = now
+            if self.available < 1:
+                return False
+            self.available -= 1
+            return True
+
+
+def billed_text(text, text_type="text"):
+    if text_type != "ssml":
+        return text
+    return "".join(html.unescape(match.group(3)) for match in ssml_token.finditer(text) if match.group(3))
+
+
+def render(text, text_type="text"):
+    # Returns the mp3 and the ssml speech marks of a text, each mark timed at the
+    # start of the frame that follows it
+    if text_type != "ssml":
+        return FRAME * max(int(len(text) / CHARACTERS_PER_SECOND / FRAME_SECONDS), 1), []
+
+    frames = 0
+    marks = []
+    for match in ssml_token.finditer(text):
+        name, break_ms, words = match.groups()
+        if name is not None:
+            marks.append({"time": round(frames * FRAME_SECONDS * 1000), "type": "ssml",
+                          "start": match.start(), "end": match.end(), "value": name})
+        elif break_ms is not None:
+            frames += round(int(break_ms) / 1000 / FRAME_SECONDS)
+        elif words is not None and words.strip():
+            frames += max(int(len(html.unescape(words)) / CHARACTERS_PER_SECOND / FRAME_SECONDS), 1)
+    return FRAME * max(frames, 1), marks
+
+
+def make_audio(text, text_type="text"):
+    return render(text, text_type)[0]
+
+
+class TaskStore:
+    # Synthesis tasks kept in memory for the life of the server, each finished
+    # by a timer that writes its audio to S3
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.s3_client = None
+
+    def get_s3_client(self):
+        import boto3
+
+        with self.lock:
+            if self.s3_client is None:
+                self.s3_client = boto3.client("s3", endpoint_url=self.args.s3_endpoint, region_name="us-east-1",
+                                              aws_access_key_id="stub", aws_secret_access_key="stub")
+            return self.s3_client
+
+    def start(self, body):
+        task_id = str(uuid.uuid4())
+        output_format = body.get("OutputFormat", "mp3")
+        key = f"{body.get('OutputS3KeyPrefix', '')}{task_id}.{output_format}"
+        task = {
+            "TaskId": task_id,
+            "TaskStatus": "scheduled",
+            "OutputUri": f"{self.args.s3_endpoint}/{body['OutputS3BucketName']}/{key}",
+            "CreationTime": time.time(),
+            "RequestCharacters": len(billed_text(body.get("Text", ""), body.get("TextType", "text"))),
+            "OutputFormat": output_format,
+            "TextType": body.get("TextType", "text"),
+            "VoiceId": body.get("VoiceId"),
+            "Engine": body.get("Engine", "standard"),
+        }
+        with self.lock:
+            self.tasks[task_id] = task
+
+        def finish():
+            try:
+                self.get_s3_client().put_object(Bucket=body["OutputS3BucketName"], Key=key,
+                                                Body=make_audio(body.get("Text", ""), body.get("TextType", "text")))
+                task["TaskStatus"] = "completed"
+            except Exception as e:
+                task["TaskStatus"] = "failed"
+                task["TaskStatusReason"] = repr(e)
+
+        task["TaskStatus"] = "inProgress"
+        threading.Timer(self.args.task_delay, finish).start()
+        return task
+
+
+def make_handler(args, limit, stats, store):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+        def send_body(self, status, payload, content_type, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def send_json(self, status, body):
+            self.send_body(status, json.dumps(body).encode("utf-8"), "application/json")
+
+        def send_error_type(self, status, error_type, message):
+            # restJson errors carry their type in a header
+            self.send_body(status, json.dumps({"message": message}).encode("utf-8"), "application/json",
+                           {"x-amzn-ErrorType": error_type})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            path = url.path.rstrip("/")
+            if path.startswith("/v1/synthesisTasks/"):
+                task = store.tasks.get(path.split("/")[-1])
+                if task is None:
+                    self.send_error_type(400, "SynthesisTaskNotFoundException", "Task not found")
+                else:
+                    self.send_json(200, {"SynthesisTask": task})
+            elif path == "/v1/synthesisTasks":
+                query = parse_qs(url.query)
+                tasks = sorted(store.tasks.values(), key=lambda task: -task["CreationTime"])
+                if "Status" in query:
+                    tasks = [task for task in tasks if task["TaskStatus"] == query["Status"][0]]
+                self.send_json(200, {"SynthesisTasks": tasks[:int(query.get("MaxResults", ["100"])[0])]})
+            else:
+                self.send_error_type(404, "UnknownOperationException", f"Unknown path {self.path}")
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            path = urlparse(self.path).path.rstrip("/")
+
+            if path == "/v1/synthesisTasks":
+                if not limit.take():
+                    stats["throttled"] += 1
+                    self.send_error_type(400, "ThrottlingException", "Rate exceeded")
+                    return
+                stats["tasks"] += 1
+                stats["characters"] += len(billed_text(body.get("Text", ""), body.get("TextType", "text")))
+                self.send_json(200, {"SynthesisTask": store.start(body)})
+            elif path == "/v1/speech":
+                self.synthesize(body)
+            else:
+                self.send_error_type(404, "UnknownOperationException", f"Unknown path {self.path}")
+
+        def synthesize(self, body):
+            text = body.get("Text", "")
+            text_type = body.get("TextType", "text")
+            billed = billed_text(text, text_type)
+            if len(billed) > SYNC_MAX_CHARS or len(text) > SSML_MAX_CHARS:
+                self.send_error_type(400, "TextLengthExceededException",
+                                     f"Maximum text length has been exceeded ({len(billed)} > {SYNC_MAX_CHARS})")
+                return
+            if not limit.take():
+                stats["throttled"] += 1
+                self.send_error_type(400, "ThrottlingException", "Rate exceeded")
+                return
+            stats["requests"] += 1
+            stats["characters"] += len(billed)
+            time.sleep(args.latency)
+            audio, marks = render(text, text_type)
+            headers = {"x-amzn-RequestCharacters": str(len(billed))}
+            if body.get("OutputFormat") == "json":
+                lines = [json.dumps(mark) for mark in marks if mark["type"] in body.get("SpeechMarkTypes", [])]
+                self.send_body(200, "".join(line + "\n" for line in lines).encode("utf-8"),
+                               "application/x-json-stream", headers)
+            else:
+                self.send_body(200, audio, "audio/mpeg", headers)
+
+    return Handler
+
+
+def main(args=None):
+    stats = {"requests": 0, "throttled": 0, "tasks": 0, "characters": 0}
+    store = TaskStore(args)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args, RateLimit(args.rps), stats, store))
+    print(f"Polly stub listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Served {stats['requests']} requests and {stats['tasks']} tasks ({stats['characters']} characters), "
+          f"throttled {stats['throttled']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Amazon Polly API")
+
+    parser.add_argument("-p", "--port", type=int, default=8082, help="Port to listen on")
+    parser.add_argument("--s3-endpoint", default="http://localhost:5000", help="S3 endpoint synthesis tasks write to")
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds spent on each synthesize_speech call")
+    parser.add_argument("--rps", type=float, default=0, help="synthesize_speech and task requests per second limit, 0 for none")
+    parser.add_argument("--task-delay", type=float, default=10.0, help="Seconds before a synthesis task completes")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,107 @@
+"""
+Speech recognition backend benchmark for transcribe_audio.
+
+Transcribes every mp3 in a folder with each backend, reports throughput as
+seconds of audio per second and, when reference transcripts are given, the
+word error rate against them.
+"""
+# run from the repo root:
+# python benchmarks/recognizers.py -i transcribe_audio/input_audios --reference transcribe_audio/text_prompts
+
+import os
+import sys
+import argparse
+import importlib.util
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_stage(stage):
+    spec = importlib.util.spec_from_file_location(stage, os.path.join(root, stage, "cli.py"))
+    module = importlib.util.module_from_spec(spec)
+    # Registered so the module's functions can be found by name from other threads
+    sys.modules[stage] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Counting:
+    # Passes segments through to a recognizer and counts the audio sent to it
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.max_pending = recognizer.max_pending
+        self.audio_bytes = 0
+
+    def submit(self, pcm):
+        self.audio_bytes += len(pcm)
+        return self.recognizer.submit(pcm)
+
+
+def word_errors(reference, hypothesis):
+    # Word level edit distance
+    reference = reference.lower().split()
+    hypothesis = hypothesis.lower().split()
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_word in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word)))
+        previous = current
+    return previous[-1], len(reference)
+
+
+def run(cli, backend, paths, args):
+    recognizer = cli.make_recognizer(backend, args.threads, args.batch_size)
+    counting = Counting(recognizer)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.files) as executor:
+        texts = list(executor.map(lambda path: cli.transcribe_recording(path, counting), paths))
+    elapsed = time.perf_counter() - start
+    recognizer.shutdown()
+
+    audio_seconds = counting.audio_bytes / (cli.SAMPLE_RATE * cli.SAMPLE_WIDTH)
+    line = (f"{backend:<8} {len(paths)} files  {audio_seconds:.0f}s audio in {elapsed:.2f}s  "
+            f"{audio_seconds / elapsed:.1f}x real time")
+
+    if args.reference:
+        errors = 0
+        words = 0
+        for path, text in zip(paths, texts):
+            reference_file = os.path.join(args.reference, os.path.basename(path).replace(".mp3", ".txt"))
+            if os.path.exists(reference_file):
+                with open(reference_file) as f:
+                    file_errors, file_words = word_errors(f.read(), text)
+                errors += file_errors
+                words += file_words
+        line += f"  WER {errors / max(words, 1):.1%} over {words} words"
+    print(line)
+
+
+def main(args=None):
+    paths = sorted(os.path.join(args.input, name) for name in os.listdir(args.input) if name.endswith(".mp3"))
+    if not paths:
+        print(f"No mp3 files in {args.input}")
+        return 1
+
+    cli = load_stage("transcribe_audio")
+    for backend in args.recognizers:
+        run(cli, backend, paths, args)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare speech recognition backends for transcribe_audio")
+
+    parser.add_argument("-i", "--input", required=True, help="Folder of mp3 files")
+    parser.add_argument("--reference", help="Folder of reference transcripts named <uuid>.txt")
+    parser.add_argument("-r", "--recognizers", nargs="+", default=["google", "whisper"], help="Backends to run")
+    parser.add_argument("-f", "--files", type=int, default=4, help="Files transcribed at once")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent requests for the google backend")
+    parser.add_argument("--batch-size", type=int, default=8, help="Segments per forward pass for the whisper backend")
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
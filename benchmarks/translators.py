@@ -0,0 +1,74 @@
+"""
+Translation backend benchmark for translate_text.
+
+Translates every paragraph in a folder with each backend, with the sentence
+cache off, and reports throughput in characters per second along with the
+characters and requests actually sent after packing and de-duplication.
+"""
+# run from the repo root:
+# python benchmarks/translators.py -i translate_text/text_paragraphs -t pseudo marian aws
+
+import os
+import sys
+import argparse
+import importlib.util
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_stage(stage):
+    spec = importlib.util.spec_from_file_location(stage, os.path.join(root, stage, "cli.py"))
+    module = importlib.util.module_from_spec(spec)
+    # Registered so the module's functions can be found by name from other threads
+    sys.modules[stage] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(cli, backend, texts, args):
+    translator = cli.make_translator(backend, args.concurrency, args.batch_size, target_language=args.target_language)
+    characters = sum(len(text) for text in texts)
+
+    start = time.perf_counter()
+    try:
+        _, sent = cli.translate_texts(texts, translator, args.batch_chars)
+    except Exception as e:
+        print(f"{backend:<8} failed: {e!r}")
+        return
+    elapsed = max(time.perf_counter() - start, 1e-6)
+
+    print(f"{backend:<8} {len(texts)} paragraphs  {characters} characters in {elapsed:.2f}s  "
+          f"{characters / elapsed:.0f} characters/s  {sent} characters sent in {translator.requests} requests")
+
+
+def main(args=None):
+    names = sorted(name for name in os.listdir(args.input) if name.endswith(".txt"))
+    if not names:
+        print(f"No text files in {args.input}")
+        return 1
+
+    texts = []
+    for name in names:
+        with open(os.path.join(args.input, name), encoding="utf-8") as f:
+            texts.append(f.read())
+
+    cli = load_stage("translate_text")
+    for backend in args.translators:
+        run(cli, backend, texts, args)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare translation backends for translate_text")
+
+    parser.add_argument("-i", "--input", required=True, help="Folder of paragraphs named <uuid>.txt")
+    parser.add_argument("-t", "--translators", nargs="+", default=["pseudo", "marian", "aws"], help="Backends to run")
+    parser.add_argument("--target-language", default="fr", help="Language code to translate into")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Concurrent requests for the aws backend")
+    parser.add_argument("--batch-chars", type=int, default=5000, help="Most characters per request")
+    parser.add_argument("--batch-size", type=int, default=16, help="Sentences per forward pass for the marian backend")
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -5,14 +5,18 @@ Module that contains the command line app.
 # export AWS_APPLICATION_CREDENTIALS=secrets/megapipeline-serviceaccount_accessKeys.csv ; export OPENAI_API_KEY_FILE=secrets/openaikey.json; python cli.py
 
 import os
+import hashlib
 import io
 import argparse
-import shutil
-import boto3
+import time
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import csv
 import json
-from openai import OpenAI
-import numpy as np
+import random
+import re
+import queue
 
 # Generate the inputs arguments parser
 parser = argparse.ArgumentParser(description="Command description.")
@@ -20,24 +24,102 @@ parser = argparse.ArgumentParser(description="Command description.")
 bucket_name = 'megapipeline-s3bucket'
 text_prompts = "text_prompts"
 text_paragraphs = "text_paragraphs"
+text_audios = "text_audios"
+cache_folder = ".response_cache"
+batch_state_file = ".batch_state.json"
 
+# Number of concurrent S3 transfers
+WORKERS = 8
 
-# Path to your CSV file
-csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
+# Multipart upload settings, the 8 MB part size matches the boto3 default so
+# ETags of objects uploaded by earlier runs still compare equal
+PART_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 10
 
-# Read the CSV file
-with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
-    reader = csv.DictReader(file)
-    credentials = next(reader)  # Assuming the CSV has only one row of credentials
+# Number of chat completions in flight at once, and retries per completion
+# on rate limits or transient server errors
+CONCURRENCY = 4
+MAX_RETRIES = 6
 
-# Extract the access key and secret key
-access_key = credentials['Access key ID']
-secret_key = credentials['Secret access key']
+# Token pre-flight: the tokenizer used for counting, how much of a transcript
+# is kept and the completion tokens reserved per request. The prompt asks for a
+# full podcast whatever the transcript length, so the reservation doesn't shrink
+# for short inputs
+TOKENIZER_NAME = os.environ.get("TOKENIZER_NAME", "Xenova/gpt-3.5-turbo")
+MODEL_CONTEXT_TOKENS = 16385
+MAX_INPUT_TOKENS = 3000
+COMPLETION_TOKENS = 700
+MESSAGE_OVERHEAD_TOKENS = 11
 
+# Response cache limits
+CACHE_MAX_MB = 256
+CACHE_MAX_AGE_DAYS = 30
 
-openai_key_file = os.environ.get('OPENAI_API_KEY_FILE')
-with open(openai_key_file, 'r') as f:
-    openai_key = json.load(f)['OPENAI_API_TOKEN']
+# Batch API limits and how often to check on submitted batches
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 200 * 1000 * 1000
+BATCH_POLL_INTERVAL = 60
+
+# Sentence sizes for --speak, Polly takes at most 3000 characters per request
+VOICE_ID = "Joanna"
+MIN_SENTENCE_CHARS = 40
+MAX_SENTENCE_CHARS = 2500
+TTS_CONCURRENCY = 4
+sentence_end = re.compile(r'[.!?]+["\')\]]*\s+|\n+')
+
+
+@lru_cache(maxsize=None)
+def get_credentials():
+    # Read on first use so --help and steps that never call AWS don't need the file
+    # Path to your CSV file
+    csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
+
+    # Read the CSV file
+    with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        credentials = next(reader)  # Assuming the CSV has only one row of credentials
+
+    # Extract the access key and secret key
+    return credentials['Access key ID'], credentials['Secret access key']
+
+
+# Size of the HTTP connection pool of every client, set from the CLI in main()
+pool_connections = WORKERS * MAX_CONCURRENCY
+
+# One session and one client per (service, region), created on first use and
+# shared by every step so a download+process+upload run keeps its connections warm
+boto3_session = None
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service, region_name=None):
+    global boto3_session
+    import boto3
+    from botocore.config import Config
+
+    with clients_lock:
+        if boto3_session is None:
+            access_key, secret_key = get_credentials()
+            # Create a boto3 session
+            boto3_session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+        if (service, region_name) not in clients:
+            clients[(service, region_name)] = boto3_session.client(
+                service,
+                region_name=region_name,
+                config=Config(max_pool_connections=pool_connections),
+            )
+        return clients[(service, region_name)]
+
+
+@lru_cache(maxsize=None)
+def get_openai_key():
+    openai_key_file = os.environ.get('OPENAI_API_KEY_FILE')
+    with open(openai_key_file, 'r') as f:
+        return json.load(f)['OPENAI_API_TOKEN']
 
 
 def makedirs():
@@ -45,86 +127,607 @@ def makedirs():
     os.makedirs(text_prompts, exist_ok=True)
 
 
-def download():
+def list_objects(s3_client, prefix):
+    # Page through the prefix, list_objects_v2 returns at most 1000 keys per call
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def report_throughput(action, count, total_bytes, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    megabytes = total_bytes / (1024 * 1024)
+    print(f"{action} {count} files ({megabytes:.2f} MB) in {elapsed:.2f}s: "
+          f"{count / elapsed:.1f} objects/s, {megabytes / elapsed:.2f} MB/s")
+
+
+def download_objects(s3_client, objects, local_folder, workers, on_downloaded=None):
+    # Bound the number of queued downloads so the listing generator is only
+    # consumed as fast as the pool drains it
+    def download_object(obj):
+        local_file_path = os.path.join(local_folder, obj['Key'].split("/")[-1])
+        s3_client.download_file(bucket_name, obj['Key'], local_file_path)
+        print(f"File {obj['Key']} downloaded to {local_file_path}")
+        return obj
+
+    start_time = time.time()
+    count = 0
+    total_bytes = 0
+
+    def finished(future):
+        nonlocal count, total_bytes
+        obj = future.result()
+        count += 1
+        total_bytes += obj['Size']
+        if on_downloaded is not None:
+            on_downloaded(obj)
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for obj in objects:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future)
+            pending.add(executor.submit(download_object, obj))
+        for future in as_completed(pending):
+            finished(future)
+
+    report_throughput("Downloaded", count, total_bytes, time.time() - start_time)
+
+
+def manifest_path(local_folder):
+    # Kept next to (not inside) the folder so os.listdir() only sees data files
+    return f".{local_folder}.manifest.json"
+
+
+def load_manifest(local_folder):
+    path = manifest_path(local_folder)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(local_folder, manifest):
+    path = manifest_path(local_folder)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def sync_objects(s3_client, objects, local_folder, workers):
+    # Mirror the listed objects into local_folder, fetching only keys whose
+    # ETag, size or last-modified changed since the previous sync
+    manifest = load_manifest(local_folder)
+    synced = {}
+    remote_files = set()
+
+    def entry(obj):
+        return {
+            'key': obj['Key'],
+            'etag': obj['ETag'],
+            'size': obj['Size'],
+            'last_modified': obj['LastModified'].isoformat(),
+        }
+
+    def changed_objects():
+        for obj in objects:
+            file_name = obj['Key'].split("/")[-1]
+            remote_files.add(file_name)
+            if manifest.get(file_name) == entry(obj) and os.path.exists(os.path.join(local_folder, file_name)):
+                synced[file_name] = manifest[file_name]
+            else:
+                yield obj
+
+    def on_downloaded(obj):
+        synced[obj['Key'].split("/")[-1]] = entry(obj)
+
+    try:
+        download_objects(s3_client, changed_objects(), local_folder, workers, on_downloaded)
+    finally:
+        save_manifest(local_folder, synced)
+
+    # Remove local files whose keys no longer exist in the bucket
+    for file_name in os.listdir(local_folder):
+        if file_name not in remote_files:
+            os.remove(os.path.join(local_folder, file_name))
+            print(f"File {file_name} removed from {local_folder}")
+
+
+def local_etag(file_path, part_size):
+    # S3 reports the MD5 of the body as the ETag of a single-part upload, and the
+    # MD5 of the concatenated part digests plus "-<parts>" for a multipart one
+    part_digests = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+
+    if os.path.getsize(file_path) < part_size:
+        return part_digests[0].hex() if part_digests else hashlib.md5(b'').hexdigest()
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f"-{len(part_digests)}"
+
+
+def transfer_config(part_size, max_concurrency):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency,
+    )
+
+
+def upload_files(s3_client, local_folder, s3_folder, workers, part_size, max_concurrency):
+    config = transfer_config(part_size, max_concurrency)
+
+    # One listing pass gives the ETag of every object already in the bucket
+    remote_etags = {obj['Key']: obj['ETag'].strip('"') for obj in list_objects(s3_client, s3_folder + "/")}
+
+    def upload_file(file_name):
+        file_path = os.path.join(local_folder, file_name)
+        object_name = f'{s3_folder}/{file_name}'  # The name of the file in the bucket, including the folder
+
+        if remote_etags.get(object_name) == local_etag(file_path, part_size):
+            return None
+
+        # Upload the file
+        s3_client.upload_file(file_path, bucket_name, object_name, Config=config)
+        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+        return os.path.getsize(file_path)
+
+    start_time = time.time()
+    count = 0
+    skipped = 0
+    total_bytes = 0
+    # Temporary files of a run that stopped mid-write are not outputs
+    file_names = [file_name for file_name in os.listdir(local_folder) if not file_name.endswith(".tmp")]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size in executor.map(upload_file, file_names):
+            if size is None:
+                skipped += 1
+            else:
+                count += 1
+                total_bytes += size
+
+    report_throughput("Uploaded", count, total_bytes, time.time() - start_time)
+    print(f"Skipped {skipped} unchanged files")
+
+
+def download(workers=WORKERS):
     print("download")
 
-    # Clear
-    shutil.rmtree(text_prompts, ignore_errors=True, onerror=None)
     makedirs()
 
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
+    s3_client = get_client('s3')
 
     # List files in the specified folder
     folder_name = 'text_prompts/'  # Replace with your folder name in S3
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=folder_name)
+    blobs = (obj for obj in list_objects(s3_client, folder_name)
+             if not obj['Key'].endswith("/") and obj['Key'].endswith(".txt"))
 
-    blobs = []
-    if 'Contents' in response:
-        for obj in response['Contents']:
-            blobs.append(obj['Key'])
-    else:
-        print(f"No files found in folder {folder_name}")
-    
-    for blob in blobs:
-        if not blob.endswith("/"):
-            # Download the file
+    sync_objects(s3_client, blobs, text_prompts, workers)
 
-            if blob.endswith(".txt"):
-                local_file_path = os.path.join(folder_name, blob.split("/")[-1])
-                s3_client.download_file(bucket_name, blob, local_file_path)
-                print(f"File {blob} downloaded to {local_file_path}")
 
+@lru_cache(maxsize=None)
+def get_openai_client():
+    # One client (and connection pool) shared by every generation thread,
+    # retries are handled by genResponse so they go through the rate limiter
+    from openai import OpenAI
+
+    return OpenAI(api_key=get_openai_key(), max_retries=0)
+
+
+class TokenBucket:
+    # Bucket refilled continuously at limit/60 per second. Capacity and level
+    # are unknown (no throttling) until the first x-ratelimit-* headers arrive
+    def __init__(self):
+        self.capacity = None
+        self.available = 0.0
+        self.rate = 0.0
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self.condition:
+            while self.capacity is not None:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+
+                amount = min(amount, self.capacity)
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                self.condition.wait((amount - self.available) / self.rate)
+
+    def update(self, limit, remaining):
+        with self.condition:
+            self.capacity = float(limit)
+            self.rate = max(self.capacity / 60, 1e-3)
+            self.available = min(float(remaining), self.capacity)
+            self.updated = time.monotonic()
+            self.condition.notify_all()
+
+
+class RateLimiter:
+    # Requests-per-minute and tokens-per-minute buckets fed by the
+    # x-ratelimit-limit-* and x-ratelimit-remaining-* response headers
+    def __init__(self):
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        # Known limits bound the very first burst, before any headers have arrived
+        if requests_per_minute:
+            self.requests.update(requests_per_minute, requests_per_minute)
+        if tokens_per_minute:
+            self.tokens.update(tokens_per_minute, tokens_per_minute)
+
+    def acquire(self, tokens):
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
+
+    def update(self, headers):
+        for name, bucket in [("requests", self.requests), ("tokens", self.tokens)]:
+            limit = headers.get(f"x-ratelimit-limit-{name}")
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            if limit is not None and remaining is not None:
+                bucket.update(limit, remaining)
 
-def genResponse(text, system_message="You are a helpful assistant."):
-    openai_client = OpenAI(api_key=openai_key)
 
-    response = openai_client.chat.completions.create( #openai.chat.completions.create( #openai.Completion.create(
+rate_limiter = RateLimiter()
+
+
+def retry_delay(headers, attempt):
+    # Prefer the server's hint, otherwise exponential backoff with jitter
+    if headers.get("retry-after-ms") is not None:
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("retry-after") is not None:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    return min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class ResponseCache:
+    # Completions keyed by a hash of everything that determines them, with
+    # hit/miss counters shared by all generation threads
+    def __init__(self, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        value = self.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def report(self):
+        total = max(self.hits + self.misses, 1)
+        print(f"Response cache: {self.hits} hits, {self.misses} misses ({100 * self.hits / total:.0f}% hit rate)")
+
+
+class DiskCache(ResponseCache):
+    # One JSON file per key holding the response and its creation time, which the age
+    # limit is checked against. The file mtime doubles as the last-used time for LRU eviction
+    def __init__(self, folder, max_bytes, max_age):
+        super().__init__(max_bytes, max_age)
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def read(self, path):
+        # Entries written before the creation time was stored fall back to their mtime
+        with open(path) as f:
+            entry = json.load(f)
+        return entry["response"], entry.get("created", os.path.getmtime(path))
+
+    def get(self, key):
+        path = os.path.join(self.folder, key + ".json")
+        try:
+            value, created = self.read(path)
+            if time.time() - created > self.max_age:
+                return None
+            os.utime(path)
+            return value
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, value):
+        # Threads storing the same response at once each write their own temporary file
+        path = os.path.join(self.folder, key + ".json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"response": value, "created": time.time()}, f)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for file_name in os.listdir(self.folder):
+            path = os.path.join(self.folder, file_name)
+            stat = os.stat(path)
+            try:
+                _, created = self.read(path)
+            except (OSError, ValueError, KeyError):
+                created = 0
+            if now - created > self.max_age:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        # Drop least recently used entries until the cache fits
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+
+
+class S3Cache(ResponseCache):
+    # Same layout under a bucket prefix so every container shares one cache.
+    # S3 has no access time, so eviction drops the oldest entries first
+    def __init__(self, prefix, max_bytes, max_age):
+        super().__init__(max_bytes, max_age)
+        self.prefix = prefix
+
+    def get(self, key):
+        s3_client = get_client('s3')
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=f"{self.prefix}/{key}.json")
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        if time.time() - response['LastModified'].timestamp() > self.max_age:
+            return None
+        return json.loads(response['Body'].read())["response"]
+
+    def put(self, key, value):
+        body = json.dumps({"response": value}).encode("utf-8")
+        get_client('s3').put_object(Bucket=bucket_name, Key=f"{self.prefix}/{key}.json", Body=body)
+
+    def evict(self):
+        s3_client = get_client('s3')
+        now = time.time()
+        expired = []
+        entries = []
+        for obj in list_objects(s3_client, self.prefix + "/"):
+            if now - obj['LastModified'].timestamp() > self.max_age:
+                expired.append(obj['Key'])
+            else:
+                entries.append((obj['LastModified'], obj['Size'], obj['Key']))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            expired.append(key)
+            total_bytes -= size
+
+        # delete_objects takes at most 1000 keys per call
+        for i in range(0, len(expired), 1000):
+            s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in expired[i:i + 1000]], 'Quiet': True},
+            )
+
+
+# Set from the CLI in main(), None disables caching
+response_cache = None
+
+
+def make_cache(backend, max_mb, max_age_days):
+    max_bytes = max_mb * 1024 * 1024
+    max_age = max_age_days * 24 * 60 * 60
+    if backend == "local":
+        return DiskCache(cache_folder, max_bytes, max_age)
+    if backend == "s3":
+        return S3Cache(cache_folder.lstrip("."), max_bytes, max_age)
+    return None
+
+
+def cache_key(request):
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+tokenizer_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer():
+    # transformers is only needed for exact counts, without it (or without the
+    # tokenizer files) counts fall back to ~4 characters per token
+    try:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+    except (ImportError, OSError) as e:
+        print(f"Tokenizer {TOKENIZER_NAME} unavailable, estimating 4 characters per token ({e})")
+        return None
+
+
+def get_tokenizer():
+    with tokenizer_lock:
+        return load_tokenizer()
+
+
+def count_tokens(text):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def truncate_tokens(text, max_tokens):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return text[:max_tokens * 4]
+    token_ids = tokenizer.encode(text, add_special_tokens=False)
+    if len(token_ids) <= max_tokens:
+        return text
+    return tokenizer.decode(token_ids[:max_tokens])
+
+
+def prompt_tokens(messages):
+    return sum(count_tokens(message["content"]) for message in messages) + MESSAGE_OVERHEAD_TOKENS
+
+
+def completion_budget(prompt_token_count):
+    # The expected output, only cut down when the prompt leaves less room in the context
+    return min(COMPLETION_TOKENS, MODEL_CONTEXT_TOKENS - prompt_token_count)
+
+
+def make_request(text, system_message="You are a helpful assistant."):
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": text}
+    ]
+    return dict(
         model= "gpt-3.5-turbo",   #"gpt-4-1106-preview", #"gpt-4-0314",  
-        messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": text}
-            ],
-        temperature=np.random.choice([0.9,0.95,0.85,0.87,0.92,0.97]),
-        max_tokens=700,
+        messages=messages,
+        # Seeded by the prompt so a re-submitted prompt maps to the same cache entry
+        temperature=random.Random(system_message + text).choice([0.9,0.95,0.85,0.87,0.92,0.97]),
+        max_tokens=completion_budget(prompt_tokens(messages)),
         top_p=1,
         frequency_penalty=1.1,
         presence_penalty=1,
         n = 1
     )
-    return response.choices[0].message.content
 
-def generate():
-    print("generate")
-    makedirs()
 
-    # Get the list of text file
-    text_files = os.listdir(text_prompts)
+def create_completion(request, **options):
+    # Send one chat completion through the rate limiter, retrying rate limits
+    # and transient errors, and return the raw response
+    from openai import RateLimitError, APIConnectionError, InternalServerError
+
+    # Prompt size plus the reserved completion is what counts against the
+    # tokens-per-minute limit
+    token_estimate = prompt_tokens(request["messages"]) + request["max_tokens"]
+
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.acquire(token_estimate)
+        try:
+            raw_response = get_openai_client().chat.completions.with_raw_response.create(**request, **options)
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            headers = e.response.headers if getattr(e, "response", None) is not None else {}
+            rate_limiter.update(headers)
+            delay = retry_delay(headers, attempt)
+            print(f"{type(e).__name__}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        rate_limiter.update(raw_response.headers)
+        return raw_response
 
-    # Get the list of text file
-    text_files = os.listdir(text_prompts)
 
-    for text_file in text_files:
+def genResponse(text, system_message="You are a helpful assistant."):
+    request = make_request(text, system_message)
+
+    key = cache_key(request)
+    if response_cache is not None:
+        cached = response_cache.lookup(key)
+        if cached is not None:
+            return cached
+
+    response = create_completion(request).parse()
+    content = response.choices[0].message.content
+    if response_cache is not None:
+        response_cache.put(key, content)
+    return content
+
+
+def genResponseStream(text, system_message="You are a helpful assistant."):
+    # Same as genResponse but yields the completion piece by piece as it is generated
+    request = make_request(text, system_message)
+
+    key = cache_key(request)
+    if response_cache is not None:
+        cached = response_cache.lookup(key)
+        if cached is not None:
+            yield cached
+            return
+
+    parts = []
+    for chunk in create_completion(request, stream=True).parse():
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+
+    if response_cache is not None:
+        response_cache.put(key, "".join(parts))
+
+
+def split_sentences(pieces, min_chars=MIN_SENTENCE_CHARS, max_chars=MAX_SENTENCE_CHARS):
+    # Cut streamed text at sentence ends. Short sentences are merged with the next
+    # one so each TTS request carries a useful amount of text, and text with no
+    # sentence end is cut at a space before it outgrows a single Polly request
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        while True:
+            match = next((m for m in sentence_end.finditer(buffer) if m.end() >= min_chars), None)
+            if match is not None:
+                cut = match.end()
+            elif len(buffer) > max_chars:
+                cut = buffer.rfind(" ", 0, max_chars) + 1 or max_chars
+            else:
+                break
+            sentence = buffer[:cut].strip()
+            buffer = buffer[cut:]
+            if sentence:
+                yield sentence
+
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def make_prompt(input_text):
+    # Oversized transcripts are cut down so they don't crowd out the completion
+    if count_tokens(input_text) > MAX_INPUT_TOKENS:
+        print(f"Truncating input of {count_tokens(input_text)} tokens to {MAX_INPUT_TOKENS}")
+        input_text = truncate_tokens(input_text, MAX_INPUT_TOKENS)
+
+    return f"""
+            Create a transcript for the podcast about cheese with 1000 or more words.
+            Use the below text as a starting point for the cheese podcast.
+            {input_text}
+        """
+
+
+def pending_prompts():
+    # Prompt files that don't have a paragraph yet
+    pending = []
+    for text_file in os.listdir(text_prompts):
+        uuid = text_file.replace(".txt", "")
+        if not os.path.exists(os.path.join(text_paragraphs, uuid + ".txt")):
+            pending.append(text_file)
+    return pending
+
+
+def generate(concurrency=CONCURRENCY):
+    print("generate")
+    makedirs()
+
+    def generate_file(text_file):
         uuid = text_file.replace(".txt", "")
         file_path = os.path.join(text_prompts, text_file)
         paragraph_file = os.path.join(text_paragraphs, uuid + ".txt")
 
-        if os.path.exists(paragraph_file):
-            continue
-
         with open(file_path) as f:
             input_text = f.read()
 
         # Generate output
-        input_prompt = f"""
-            Create a transcript for the podcast about cheese with 1000 or more words.
-            Use the below text as a starting point for the cheese podcast.
-            {input_text}
-        """
+        input_prompt = make_prompt(input_text)
         print(input_prompt,"\n\n\n")
         
         paragraph = genResponse(input_prompt)
@@ -136,30 +739,287 @@ def generate():
         with open(paragraph_file, "w") as f:
             f.write(paragraph)
 
+    pending = pending_prompts()
 
-def upload():
-    print("upload")
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in executor.map(generate_file, pending):
+            pass
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"Generated {len(pending)} paragraphs in {elapsed:.2f}s: {len(pending) / elapsed:.2f} paragraphs/s")
+
+    if response_cache is not None:
+        response_cache.report()
+        response_cache.evict()
+
+
+def load_batch_state():
+    if not os.path.exists(batch_state_file):
+        return None
+    with open(batch_state_file) as f:
+        return json.load(f)
+
+
+def save_batch_state(state):
+    with open(batch_state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(batch_state_file + ".tmp", batch_state_file)
+
+
+def pack_batch_lines(batch_requests):
+    # Group the JSONL lines of the requests into input files of at most BATCH_MAX_REQUESTS
+    # lines and BATCH_MAX_BYTES bytes
+    lines = []
+    size = 0
+    for request in batch_requests:
+        line = (json.dumps(request) + "\n").encode("utf-8")
+        if lines and (len(lines) == BATCH_MAX_REQUESTS or size + len(line) > BATCH_MAX_BYTES):
+            yield lines
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield lines
+
+
+def submit_batches():
+    openai_client = get_openai_client()
+    state = {"batches": []}
+
+    batch_requests = []
+    for text_file in pending_prompts():
+        uuid = text_file.replace(".txt", "")
+        with open(os.path.join(text_prompts, text_file)) as f:
+            request = make_request(make_prompt(f.read()))
+
+        # Prompts answered before don't need to go through the batch at all
+        cached = response_cache.lookup(cache_key(request)) if response_cache is not None else None
+        if cached is not None:
+            with open(os.path.join(text_paragraphs, uuid + ".txt"), "w") as f:
+                f.write(cached)
+            continue
+
+        batch_requests.append({"custom_id": uuid, "method": "POST", "url": "/v1/chat/completions", "body": request})
+
+    for i, lines in enumerate(pack_batch_lines(batch_requests)):
+        input_path = f".batch_input_{i}.jsonl"
+        with open(input_path, "wb") as f:
+            f.writelines(lines)
+
+        with open(input_path, "rb") as f:
+            input_file = openai_client.files.create(file=f, purpose="batch")
+        os.remove(input_path)
+
+        batch_job = openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Submitted batch {batch_job.id} with {len(lines)} requests, {sum(map(len, lines)) / 1e6:.1f} MB")
+
+        # Saved after every submission so a restart resumes polling instead of submitting twice
+        state["batches"].append({"id": batch_job.id, "status": batch_job.status})
+        save_batch_state(state)
+
+    return state
+
+
+def write_batch_results(output_file_id):
+    content = get_openai_client().files.content(output_file_id).text
+
+    count = 0
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        uuid = result["custom_id"]
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            print(f"Request {uuid} failed: {result.get('error') or response.get('body')}")
+            continue
+
+        paragraph = response["body"]["choices"][0]["message"]["content"]
+        paragraph_file = os.path.join(text_paragraphs, uuid + ".txt")
+        with open(paragraph_file + ".tmp", "w") as f:
+            f.write(paragraph)
+        os.replace(paragraph_file + ".tmp", paragraph_file)
+        count += 1
+
+        if response_cache is not None:
+            with open(os.path.join(text_prompts, uuid + ".txt")) as f:
+                response_cache.put(cache_key(make_request(make_prompt(f.read()))), paragraph)
+
+    print(f"Wrote {count} paragraphs from {output_file_id}")
+
+
+def batch(poll_interval=BATCH_POLL_INTERVAL):
+    # Generate every pending prompt through the Batch API, the batch ids are kept
+    # in batch_state_file so an interrupted run picks up where it left off
+    print("batch")
     makedirs()
 
-    # Get the list of text file
-    text_files = os.listdir(text_paragraphs)
-    print(text_files)
+    openai_client = get_openai_client()
 
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
+    state = load_batch_state()
+    if state is None:
+        state = submit_batches()
+    else:
+        print(f"Resuming {len(state['batches'])} batches from {batch_state_file}")
 
-    folder_name = text_paragraphs
-    for text_file in text_files:
-        file_path = os.path.join(text_paragraphs, text_file)
-        object_name = f'{folder_name}/{text_file}'  # The name of the file in the bucket, including the folder
+    finished = ["completed", "failed", "expired", "cancelled"]
+    while True:
+        for entry in state["batches"]:
+            if entry["status"] in finished:
+                continue
 
-        # Upload the file
-        s3_client.upload_file(file_path, bucket_name, object_name)
-        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+            batch_job = openai_client.batches.retrieve(entry["id"])
+            counts = batch_job.request_counts
+            if counts is not None:
+                print(f"Batch {batch_job.id}: {batch_job.status}, {counts.completed}/{counts.total} completed, {counts.failed} failed")
+            else:
+                print(f"Batch {batch_job.id}: {batch_job.status}")
+
+            if batch_job.status in finished:
+                # Expired and cancelled batches still return the requests that finished
+                if batch_job.output_file_id:
+                    write_batch_results(batch_job.output_file_id)
+                if batch_job.error_file_id:
+                    write_batch_results(batch_job.error_file_id)
+                if batch_job.errors:
+                    print(f"Batch {batch_job.id} errors: {batch_job.errors}")
+
+            entry["status"] = batch_job.status
+            save_batch_state(state)
+
+        if all(entry["status"] in finished for entry in state["batches"]):
+            break
+        time.sleep(poll_interval)
+
+    if os.path.exists(batch_state_file):
+        os.remove(batch_state_file)
+
+    if response_cache is not None:
+        response_cache.report()
+        response_cache.evict()
+
+
+def speak(concurrency=CONCURRENCY):
+    # Stream each completion into Polly one sentence at a time and append the audio
+    # to text_audios/<uuid>.mp3 as it arrives, so playback can start after the first sentence
+    print("speak")
+    makedirs()
+    os.makedirs(text_audios, exist_ok=True)
+
+    polly_client = get_client('polly', region_name='us-east-1')
+
+    def synthesize(sentence):
+        response = polly_client.synthesize_speech(
+            Text=sentence,
+            OutputFormat="mp3",
+            VoiceId=VOICE_ID,
+        )
+        return response["AudioStream"].read()
+
+    def speak_file(text_file):
+        uuid = text_file.replace(".txt", "")
+        with open(os.path.join(text_prompts, text_file)) as f:
+            input_text = f.read()
+
+        start_time = time.time()
+        first_audio = None
+        pieces = []
+
+        def collect():
+            for piece in genResponseStream(make_prompt(input_text)):
+                pieces.append(piece)
+                yield piece
+
+        # MP3 frames from separate requests can simply be appended. A writer thread
+        # takes the synthesis futures in sentence order and writes each one as soon
+        # as it is done, while later sentences are still being generated
+        segments = queue.Queue()
+
+        def write_segments(out):
+            nonlocal first_audio
+            while True:
+                future = segments.get()
+                if future is None:
+                    return
+                out.write(future.result())
+                out.flush()
+                if first_audio is None:
+                    first_audio = time.time() - start_time
+
+        # Both files are written under a temporary name and renamed once complete, so a
+        # failed stream or Polly call never leaves a truncated mp3 that --upload would push
+        audio_file = os.path.join(text_audios, uuid + ".mp3")
+        with open(audio_file + ".tmp", "wb") as out, ThreadPoolExecutor(max_workers=TTS_CONCURRENCY + 1) as executor:
+            writer = executor.submit(write_segments, out)
+            try:
+                for sentence in split_sentences(collect()):
+                    segments.put(executor.submit(synthesize, sentence))
+            finally:
+                segments.put(None)
+            writer.result()
+        os.replace(audio_file + ".tmp", audio_file)
+
+        paragraph_file = os.path.join(text_paragraphs, uuid + ".txt")
+        with open(paragraph_file + ".tmp", "w") as f:
+            f.write("".join(pieces))
+        os.replace(paragraph_file + ".tmp", paragraph_file)
+
+        print(f"{uuid}: first audio after {first_audio or 0:.2f}s, done after {time.time() - start_time:.2f}s")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in executor.map(speak_file, pending_prompts()):
+            pass
+
+
+def stream(concurrency=CONCURRENCY):
+    # Read prompts straight from S3 and write paragraphs straight back, no local folders
+    print("stream")
+
+    s3_client = get_client('s3')
+
+    # Prompts that already have a paragraph in the bucket are skipped
+    done = {obj['Key'].split("/")[-1] for obj in list_objects(s3_client, text_paragraphs + "/")}
+
+    def stream_object(obj):
+        text_file = obj['Key'].split("/")[-1]
+
+        response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
+        input_text = response['Body'].read().decode("utf-8")
+
+        paragraph = genResponse(make_prompt(input_text))
+
+        object_name = f'{text_paragraphs}/{text_file}'
+        s3_client.put_object(Bucket=bucket_name, Key=object_name, Body=paragraph.encode("utf-8"))
+        print(f"Paragraph for {obj['Key']} uploaded to {bucket_name}/{object_name}")
+
+    pending = (obj for obj in list_objects(s3_client, text_prompts + "/")
+               if obj['Key'].endswith(".txt") and obj['Key'].split("/")[-1] not in done)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in executor.map(stream_object, pending):
+            pass
+
+    if response_cache is not None:
+        response_cache.report()
+        response_cache.evict()
+
+
+def upload(workers=WORKERS, part_size=PART_SIZE, max_concurrency=MAX_CONCURRENCY):
+    print("upload")
+    makedirs()
+
+    s3_client = get_client('s3')
+
+    upload_files(s3_client, text_paragraphs, text_paragraphs, workers, part_size, max_concurrency)
+
+    # Audio written by --speak
+    if os.path.isdir(text_audios):
+        upload_files(s3_client, text_audios, text_audios, workers, part_size, max_concurrency)
 
 
     # # Upload to bucket
@@ -182,12 +1042,23 @@ def upload():
 def main(args=None):
     print("Args:", args)
 
+    global pool_connections, response_cache
+    pool_connections = args.workers * args.max_concurrency
+    response_cache = make_cache(args.cache, args.cache_max_mb, args.cache_max_age_days)
+    rate_limiter.configure(args.rpm, args.tpm)
+
+    if args.stream:
+        stream(concurrency=args.concurrency)
     if args.download:
-        download()
+        download(workers=args.workers)
     if args.generate:
-        generate()
+        generate(concurrency=args.concurrency)
+    if args.batch:
+        batch(poll_interval=args.poll_interval)
+    if args.speak:
+        speak(concurrency=args.concurrency)
     if args.upload:
-        upload()
+        upload(workers=args.workers, part_size=args.part_size * 1024 * 1024, max_concurrency=args.max_concurrency)
 
 
 
@@ -214,6 +1085,97 @@ if __name__ == "__main__":
         help="Upload paragraph text to GCS bucket",
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of concurrent S3 transfers",
+    )
+
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=PART_SIZE // (1024 * 1024),
+        help="Multipart upload part size in MB",
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Number of concurrent part uploads per file",
+    )
+
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="Generate text paragraphs through the OpenAI Batch API",
+    )
+
+    parser.add_argument(
+        "--speak",
+        action="store_true",
+        help="Stream each paragraph sentence by sentence into Polly and save the audio",
+    )
+
+    parser.add_argument(
+        "--poll-interval",
+        type=int,
+        default=BATCH_POLL_INTERVAL,
+        help="Seconds between batch status checks",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help="Number of chat completions in flight at once",
+    )
+
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="Requests per minute limit of the OpenAI account, if known",
+    )
+
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=None,
+        help="Tokens per minute limit of the OpenAI account, if known",
+    )
+
+    parser.add_argument(
+        "--cache",
+        choices=["local", "s3", "off"],
+        default="local",
+        help="Where to cache generated responses",
+    )
+
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=CACHE_MAX_MB,
+        help="Maximum size of the response cache in MB",
+    )
+
+    parser.add_argument(
+        "--cache-max-age-days",
+        type=int,
+        default=CACHE_MAX_AGE_DAYS,
+        help="Maximum age of a cached response in days",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream inputs from S3 through the stage and back to S3 without local files",
+    )
+
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,488 @@
+"""
+Runs the pipeline stages in one process, one item at a time.
+"""
+# Each stage's cli.py is loaded as a module and its per-file functions are chained
+# with bounded queues, so one recording can be generating text while the next is
+# being transcribed and the previous one is being synthesized. Stage outputs are
+# written to the usual folders under --workdir, so the stages' own --upload still works.
+#
+# export AWS_APPLICATION_CREDENTIALS=... OPENAI_API_KEY_FILE=...
+# python pipeline.py --workdir data -d -u
+
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import importlib.util
+
+root = os.path.dirname(os.path.abspath(__file__))
+bucket_name = 'megapipeline-s3bucket'
+input_audios = "input_audios"
+
+# Items waiting between two stages, a full queue holds the stage before it back
+QUEUE_SIZE = 4
+
+# Workers of each stage
+TRANSCRIBE_WORKERS = 2
+GENERATE_WORKERS = 4
+SYNTHESIS_WORKERS = 4
+
+# Polly requests started per second by the synthesis workers together
+POLLY_RPS = 20
+
+# Seconds between status checks of the Polly synthesis tasks of long paragraphs
+TASK_POLL_INTERVAL = 5
+
+# Status checks of one synthesis task that may fail in a row before its item is given up
+TASK_CHECK_RETRIES = 5
+
+# Passed down a queue after the last item
+DONE = object()
+
+
+def load_stage(name):
+    # Every stage is a cli.py in its own folder, load each one under its folder name
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(root, name, "cli.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+class Stage:
+    # A pool of threads applying process(uuid, value) -> value to the items of the input
+    # queue and passing the results on. Items that fail are reported and dropped
+    def __init__(self, name, process, workers, inbox, outbox):
+        self.name = name
+        self.process = process
+        self.workers = workers
+        self.inbox = inbox
+        self.outbox = outbox
+        self.running = workers
+        self.seconds = 0.0
+        self.count = 0
+        self.failed = []
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.run, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is DONE:
+                # Put it back for the other workers, the last one to stop tells the next stage
+                self.inbox.put(DONE)
+                with self.lock:
+                    self.running -= 1
+                    last = self.running == 0
+                if last:
+                    self.outbox.put(DONE)
+                return
+
+            uuid, value, timings = item
+            start_time = time.time()
+            try:
+                value = self.process(uuid, value)
+            except Exception as e:
+                print(f"{self.name} failed for {uuid}: {e!r}")
+                with self.lock:
+                    self.failed.append(uuid)
+                continue
+            elapsed = time.time() - start_time
+
+            with self.lock:
+                self.seconds += elapsed
+                self.count += 1
+            timings[self.name] = elapsed
+            self.outbox.put((uuid, value, timings))
+
+    def report(self):
+        average = self.seconds / max(self.count, 1)
+        print(f"{self.name}: {self.count} items, {average:.2f}s per item with {self.workers} workers, "
+              f"{len(self.failed)} failed")
+
+
+class SynthesisTask:
+    # Passed on by the synthesis stage for a paragraph voiced by a Polly synthesis task
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
+class TaskPoller:
+    # The one thread that owns the Polly synthesis tasks of the pipeline. Synthesis workers
+    # start the tasks of paragraphs too long for synthesize_speech and pass their ids on,
+    # this thread polls all of them together and passes each item on once its audio is in
+    # the bucket. Other items go straight through. Running tasks are kept in the stage's
+    # state file so a restart picks them up
+    def __init__(self, inbox, outbox, poll_interval):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.poll_interval = poll_interval
+        self.completed = 0
+        self.failed = []
+        self.thread = threading.Thread(target=self.run, name="tasks", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        synthesis_audio_en = load_stage("synthesis_audio_en")
+        s3_client = synthesis_audio_en.get_client('s3')
+        polly_client = synthesis_audio_en.get_client('polly', region_name='us-east-1')
+
+        # Also holds tasks of an earlier run that this run hasn't reached yet
+        tasks = synthesis_audio_en.load_tasks_state()
+        waiting = {}
+        errors = {}
+        inputs_done = False
+        next_poll = 0
+
+        while not inputs_done or waiting:
+            try:
+                item = self.inbox.get(timeout=max(next_poll - time.monotonic(), 0) if waiting else None)
+            except queue.Empty:
+                item = None
+
+            if item is DONE:
+                inputs_done = True
+            elif item is not None:
+                uuid, value, _ = item
+                if not isinstance(value, SynthesisTask):
+                    self.outbox.put(item)
+                    continue
+                if not waiting:
+                    next_poll = time.monotonic() + self.poll_interval
+                tasks[uuid] = value.task_id
+                synthesis_audio_en.save_tasks_state(tasks)
+                waiting[uuid] = (item, time.time())
+                errors[uuid] = 0
+
+            if not waiting or time.monotonic() < next_poll:
+                continue
+            for uuid in list(waiting):
+                try:
+                    status = synthesis_audio_en.check_task(polly_client, s3_client, uuid, tasks[uuid])
+                except Exception as e:
+                    # Throttling or a network error, the task keeps running so check it again
+                    # on the next poll. After too many errors in a row the item is given up,
+                    # the task stays in the state file for the next run
+                    errors[uuid] += 1
+                    print(f"Synthesis task of {uuid} could not be checked "
+                          f"({errors[uuid]} of {TASK_CHECK_RETRIES}): {e!r}")
+                    if errors[uuid] >= TASK_CHECK_RETRIES:
+                        self.failed.append(uuid)
+                        del waiting[uuid], errors[uuid]
+                    continue
+                errors[uuid] = 0
+                if status not in ("completed", "failed"):
+                    continue
+                (uuid, _, timings), queued = waiting.pop(uuid)
+                del tasks[uuid], errors[uuid]
+                if status == "completed":
+                    timings["task"] = time.time() - queued
+                    self.completed += 1
+                    self.outbox.put((uuid, f"{synthesis_audio_en.text_audios}/{uuid}.mp3", timings))
+                else:
+                    self.failed.append(uuid)
+
+            if tasks:
+                synthesis_audio_en.save_tasks_state(tasks)
+            elif os.path.exists(synthesis_audio_en.tasks_state_file):
+                os.remove(synthesis_audio_en.tasks_state_file)
+            if waiting:
+                print(f"{len(waiting)} synthesis tasks running, checking again in {self.poll_interval}s")
+            next_poll = time.monotonic() + self.poll_interval
+
+        self.outbox.put(DONE)
+
+    def report(self):
+        print(f"synthesis tasks: {self.completed} completed, {len(self.failed)} failed")
+
+
+def upload_file(file_path, folder):
+    s3_client = load_stage("transcribe_audio").get_client('s3')
+    object_name = f"{folder}/{os.path.basename(file_path)}"
+    s3_client.upload_file(file_path, bucket_name, object_name)
+    print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+
+
+def make_transcribe(recognizer, upload):
+    transcribe_audio = load_stage("transcribe_audio")
+
+    def transcribe(uuid, audio_path):
+        text_file = os.path.join(transcribe_audio.text_prompts, uuid + ".txt")
+        if os.path.exists(text_file):
+            with open(text_file) as f:
+                return f.read()
+
+        text = transcribe_audio.transcribe_cached(audio_path, recognizer)
+        transcribe_audio.write_text(text_file, text)
+        print(f"Transcript of {uuid} written to {text_file}")
+        if upload:
+            upload_file(text_file, transcribe_audio.text_prompts)
+        return text
+
+    return transcribe
+
+
+def make_generate(upload):
+    generate_text = load_stage("generate_text")
+
+    def generate(uuid, text):
+        paragraph_file = os.path.join(generate_text.text_paragraphs, uuid + ".txt")
+        if os.path.exists(paragraph_file):
+            with open(paragraph_file) as f:
+                return f.read()
+
+        paragraph = generate_text.genResponse(generate_text.make_prompt(text))
+        with open(paragraph_file + ".tmp", "w") as f:
+            f.write(paragraph)
+        os.replace(paragraph_file + ".tmp", paragraph_file)
+        print(f"Paragraph of {uuid} written to {paragraph_file}")
+        if upload:
+            upload_file(paragraph_file, generate_text.text_paragraphs)
+        return paragraph
+
+    return generate
+
+
+def audio_in_bucket(object_name):
+    from botocore.exceptions import ClientError
+
+    s3_client = load_stage("synthesis_audio_en").get_client('s3')
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=object_name)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def make_synthesize(rps, upload):
+    synthesis_audio_en = load_stage("synthesis_audio_en")
+    polly_client = synthesis_audio_en.get_client('polly', region_name='us-east-1')
+    limiter = synthesis_audio_en.RateLimiter(rps)
+
+    def synthesize(uuid, paragraph):
+        audio_file = os.path.join(synthesis_audio_en.text_audios, uuid + ".mp3")
+        if os.path.exists(audio_file):
+            return audio_file
+
+        if len(paragraph) > synthesis_audio_en.SYNC_MAX_CHARS:
+            # Written straight to the bucket by a synthesis task, which the TaskPoller
+            # behind this stage waits for
+            object_name = f"{synthesis_audio_en.text_audios}/{uuid}.mp3"
+            if audio_in_bucket(object_name):
+                return object_name
+            task_id = synthesis_audio_en.load_tasks_state().get(uuid)
+            if task_id is None:
+                task_id = synthesis_audio_en.start_task(polly_client, limiter, uuid, paragraph)
+            return SynthesisTask(task_id)
+
+        synthesis_audio_en.synthesize_text(polly_client, limiter, uuid, paragraph, audio_file)
+        if upload:
+            upload_file(audio_file, synthesis_audio_en.text_audios)
+        return audio_file
+
+    return synthesize
+
+
+def read_inputs(download):
+    # Yield (uuid, mp3 path) for every recording, fetching each one from the bucket
+    # just before it enters the pipeline with --download
+    transcribe_audio = load_stage("transcribe_audio")
+
+    if not download:
+        for audio_file in sorted(os.listdir(input_audios)):
+            if audio_file.endswith(".mp3"):
+                yield audio_file.replace(".mp3", ""), os.path.join(input_audios, audio_file)
+        return
+
+    s3_client = transcribe_audio.get_client('s3')
+    for obj in transcribe_audio.list_objects(s3_client, input_audios + "/"):
+        if not obj['Key'].endswith(".mp3"):
+            continue
+        audio_path = os.path.join(input_audios, obj['Key'].split("/")[-1])
+        if not os.path.exists(audio_path):
+            s3_client.download_file(bucket_name, obj['Key'], audio_path + ".tmp")
+            os.replace(audio_path + ".tmp", audio_path)
+        yield obj['Key'].split("/")[-1].replace(".mp3", ""), audio_path
+
+
+def run(args):
+    transcribe_audio = load_stage("transcribe_audio")
+    generate_text = load_stage("generate_text")
+    synthesis_audio_en = load_stage("synthesis_audio_en")
+
+    for folder in [input_audios, transcribe_audio.text_prompts, generate_text.text_paragraphs,
+                   synthesis_audio_en.text_audios]:
+        os.makedirs(folder, exist_ok=True)
+
+    # Caches as each stage's own CLI sets them up
+    transcribe_audio.transcript_cache = transcribe_audio.make_cache(args.cache, transcribe_audio.CACHE_MAX_MB)
+    generate_text.response_cache = generate_text.make_cache(args.cache, generate_text.CACHE_MAX_MB,
+                                                            generate_text.CACHE_MAX_AGE_DAYS)
+    synthesis_audio_en.audio_cache = synthesis_audio_en.make_cache(args.cache, synthesis_audio_en.CACHE_MAX_MB)
+
+    recognizer = transcribe_audio.make_recognizer(args.recognizer, transcribe_audio.RECOGNIZE_THREADS,
+                                                  transcribe_audio.BATCH_SIZE)
+
+    queues = [queue.Queue(maxsize=args.queue_size) for _ in range(5)]
+    stages = [
+        Stage("transcribe", make_transcribe(recognizer, args.upload), args.transcribe_workers, queues[0], queues[1]),
+        Stage("generate", make_generate(args.upload), args.generate_workers, queues[1], queues[2]),
+        Stage("synthesize", make_synthesize(args.rps, args.upload), args.synthesis_workers, queues[2], queues[3]),
+    ]
+    poller = TaskPoller(queues[3], queues[4], args.poll_interval)
+    for stage in stages:
+        stage.start()
+    poller.start()
+
+    start_time = time.time()
+    started = {}
+
+    feed_errors = []
+
+    def feed():
+        try:
+            for uuid, audio_path in read_inputs(args.download):
+                started[uuid] = time.time()
+                queues[0].put((uuid, audio_path, {}))
+        except Exception as e:
+            # The items already queued still finish, the error is raised once they have
+            print(f"Reading inputs failed: {e!r}")
+            feed_errors.append(e)
+        finally:
+            queues[0].put(DONE)
+
+    feeder = threading.Thread(target=feed, name="feed", daemon=True)
+    feeder.start()
+
+    latencies = []
+    while True:
+        item = queues[-1].get()
+        if item is DONE:
+            break
+        uuid, _, timings = item
+        latencies.append(time.time() - started[uuid])
+        print(f"{uuid} done after {latencies[-1]:.2f}s (" +
+              ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()) + ")")
+    feeder.join()
+    recognizer.shutdown()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"Pipeline finished {len(latencies)} items in {elapsed:.2f}s: {len(latencies) / elapsed:.2f} items/s")
+    if latencies:
+        print(f"Latency per item: {sum(latencies) / len(latencies):.2f}s average, {max(latencies):.2f}s max")
+    for stage in stages:
+        stage.report()
+    poller.report()
+
+    for cache in [transcribe_audio.transcript_cache, generate_text.response_cache, synthesis_audio_en.audio_cache]:
+        if cache is not None:
+            cache.report()
+            cache.evict()
+
+    if feed_errors:
+        raise feed_errors[0]
+
+
+def main(args=None):
+    print("Args:", args)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    run(args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run transcribe_audio, generate_text and synthesis_audio_en "
+                                                 "as one streaming pipeline")
+
+    parser.add_argument(
+        "--workdir",
+        default=".",
+        help="Folder holding input_audios and the folders every stage writes",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--download",
+        action="store_true",
+        help="Fetch each recording from the bucket as it enters the pipeline",
+    )
+
+    parser.add_argument(
+        "-u",
+        "--upload",
+        action="store_true",
+        help="Upload each stage's output to the bucket as soon as it is written",
+    )
+
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=QUEUE_SIZE,
+        help="Most items waiting between two stages",
+    )
+
+    parser.add_argument(
+        "--transcribe-workers",
+        type=int,
+        default=TRANSCRIBE_WORKERS,
+        help="Recordings transcribed at once",
+    )
+
+    parser.add_argument(
+        "--generate-workers",
+        type=int,
+        default=GENERATE_WORKERS,
+        help="Paragraphs generated at once",
+    )
+
+    parser.add_argument(
+        "--synthesis-workers",
+        type=int,
+        default=SYNTHESIS_WORKERS,
+        help="Paragraphs synthesized at once",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--recognizer",
+        choices=["google", "whisper"],
+        default="google",
+        help="Speech recognition backend of transcribe_audio",
+    )
+
+    parser.add_argument(
+        "--rps",
+        type=float,
+        default=POLLY_RPS,
+        help="Most Polly requests started per second, 0 for no limit",
+    )
+
+    parser.add_argument(
+        "--poll-interval",
+        type=int,
+        default=TASK_POLL_INTERVAL,
+        help="Seconds between status checks of Polly synthesis tasks for long paragraphs",
+    )
+
+    parser.add_argument(
+        "--cache",
+        choices=["local", "off"],
+        default="local",
+        help="Use each stage's local cache",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
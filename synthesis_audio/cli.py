@@ -2,12 +2,19 @@
 Module that contains the command line app.
 """
 import os
+import io
+import hashlib
 import argparse
-import shutil
 import json
 import csv
-import boto3
-import requests 
+import time
+import random
+import re
+import threading
+import unicodedata
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 # Generate the inputs arguments parser
 parser = argparse.ArgumentParser(description="Command description.")
 
@@ -15,21 +22,90 @@ parser = argparse.ArgumentParser(description="Command description.")
 bucket_name = 'megapipeline-s3bucket'
 output_audios = "output_audios_pp"
 text_translated = "text_translated"
-
-
-# Path to your CSV file
-csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
-
-# Read the CSV file
-with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
-    reader = csv.DictReader(file)
-    credentials = next(reader)  # Assuming the CSV has only one row of credentials
-
-# Extract the access key and secret key
-access_key = credentials['Access key ID']
-secret_key = credentials['Secret access key']
-
-CHUNK_SIZE = 1024
+cache_folder = ".tts_cache"
+
+# Number of concurrent S3 transfers
+WORKERS = 8
+
+# Multipart upload settings, the 8 MB part size matches the boto3 default so
+# ETags of objects uploaded by earlier runs still compare equal
+PART_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 10
+
+
+@lru_cache(maxsize=None)
+def get_credentials():
+    # Read on first use so --help and steps that never call AWS don't need the file
+    # Path to your CSV file
+    csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
+
+    # Read the CSV file
+    with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        credentials = next(reader)  # Assuming the CSV has only one row of credentials
+
+    # Extract the access key and secret key
+    return credentials['Access key ID'], credentials['Secret access key']
+
+
+# Size of the HTTP connection pool of every client, set from the CLI in main()
+pool_connections = WORKERS * MAX_CONCURRENCY
+
+# One session and one client per (service, region), created on first use and
+# shared by every step so a download+process+upload run keeps its connections warm
+boto3_session = None
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service, region_name=None):
+    global boto3_session
+    import boto3
+    from botocore.config import Config
+
+    with clients_lock:
+        if boto3_session is None:
+            access_key, secret_key = get_credentials()
+            # Create a boto3 session
+            boto3_session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+        if (service, region_name) not in clients:
+            clients[(service, region_name)] = boto3_session.client(
+                service,
+                region_name=region_name,
+                config=Config(max_pool_connections=pool_connections),
+            )
+        return clients[(service, region_name)]
+
+# Audio is streamed to disk in CHUNK_SIZE reads, large enough that a few MB of mp3
+# takes a handful of writes instead of thousands
+CHUNK_SIZE = 256 * 1024
+
+# Number of texts synthesized at once, ElevenLabs plans allow 2 to 15 concurrent requests
+TTS_CONCURRENCY = 4
+
+# Long texts are split at sentence ends into chunks of at most MAX_CHUNK_CHARS that
+# are synthesized concurrently, a failed chunk is retried on its own
+MAX_CHUNK_CHARS = 800
+CHUNK_RETRIES = 6
+MAX_THROTTLED = 50
+sentence_end = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\')\]»])\s+')
+
+# The in-flight request limit starts at the configured concurrency, halves on a 429,
+# a 5xx or a first byte slower than LATENCY_TARGET seconds and grows back by one per
+# limit's worth of successes. CHAR_QUOTA characters per QUOTA_WINDOW seconds, 0 for none
+LATENCY_TARGET = 3.0
+CHAR_QUOTA = 0
+QUOTA_WINDOW = 60
+
+# Audio of text voiced before is reused, the local cache keeps the most recently
+# used entries up to CACHE_MAX_MB
+CACHE_MAX_MB = 512
+
+# Point at a local stand-in with ELEVENLABS_BASE_URL=http://localhost:8081
+ELEVENLABS_BASE_URL = os.environ.get("ELEVENLABS_BASE_URL", "https://api.elevenlabs.io")
 
 # Pavlos Voice id
 
@@ -38,132 +114,734 @@ VOICE_ID = "TG3keNw5JZvsEiTtWt7t"
 #Define the path to the secrets file
 secrets_file_path = 'secrets/11lab_api_key.txt'
 
-# Read the file and set the environment variable
-with open(secrets_file_path) as f:
-    for line in f:
-        if 'XI_API_KEY' in line:
-            key, value = line.strip().split('=')
-            os.environ[key] = value
 
-XI_API_KEY = os.environ['XI_API_KEY']  
+@lru_cache(maxsize=None)
+def get_xi_api_key():
+    # Read the file and set the environment variable
+    if os.path.exists(secrets_file_path):
+        with open(secrets_file_path) as f:
+            for line in f:
+                if 'XI_API_KEY' in line:
+                    key, value = line.strip().split('=')
+                    os.environ[key] = value
+
+    return os.environ['XI_API_KEY']
+
 
 def makedirs():
     os.makedirs(output_audios, exist_ok=True)
     os.makedirs(text_translated, exist_ok=True)
 
 
-def download():
+def list_objects(s3_client, prefix):
+    # Page through the prefix, list_objects_v2 returns at most 1000 keys per call
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def report_throughput(action, count, total_bytes, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    megabytes = total_bytes / (1024 * 1024)
+    print(f"{action} {count} files ({megabytes:.2f} MB) in {elapsed:.2f}s: "
+          f"{count / elapsed:.1f} objects/s, {megabytes / elapsed:.2f} MB/s")
+
+
+def download_objects(s3_client, objects, local_folder, workers, on_downloaded=None):
+    # Bound the number of queued downloads so the listing generator is only
+    # consumed as fast as the pool drains it
+    def download_object(obj):
+        local_file_path = os.path.join(local_folder, obj['Key'].split("/")[-1])
+        s3_client.download_file(bucket_name, obj['Key'], local_file_path)
+        print(f"File {obj['Key']} downloaded to {local_file_path}")
+        return obj
+
+    start_time = time.time()
+    count = 0
+    total_bytes = 0
+
+    def finished(future):
+        nonlocal count, total_bytes
+        obj = future.result()
+        count += 1
+        total_bytes += obj['Size']
+        if on_downloaded is not None:
+            on_downloaded(obj)
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for obj in objects:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future)
+            pending.add(executor.submit(download_object, obj))
+        for future in as_completed(pending):
+            finished(future)
+
+    report_throughput("Downloaded", count, total_bytes, time.time() - start_time)
+
+
+def manifest_path(local_folder):
+    # Kept next to (not inside) the folder so os.listdir() only sees data files
+    return f".{local_folder}.manifest.json"
+
+
+def load_manifest(local_folder):
+    path = manifest_path(local_folder)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(local_folder, manifest):
+    path = manifest_path(local_folder)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def sync_objects(s3_client, objects, local_folder, workers):
+    # Mirror the listed objects into local_folder, fetching only keys whose
+    # ETag, size or last-modified changed since the previous sync
+    manifest = load_manifest(local_folder)
+    synced = {}
+    remote_files = set()
+
+    def entry(obj):
+        return {
+            'key': obj['Key'],
+            'etag': obj['ETag'],
+            'size': obj['Size'],
+            'last_modified': obj['LastModified'].isoformat(),
+        }
+
+    def changed_objects():
+        for obj in objects:
+            file_name = obj['Key'].split("/")[-1]
+            remote_files.add(file_name)
+            if manifest.get(file_name) == entry(obj) and os.path.exists(os.path.join(local_folder, file_name)):
+                synced[file_name] = manifest[file_name]
+            else:
+                yield obj
+
+    def on_downloaded(obj):
+        synced[obj['Key'].split("/")[-1]] = entry(obj)
+
+    try:
+        download_objects(s3_client, changed_objects(), local_folder, workers, on_downloaded)
+    finally:
+        save_manifest(local_folder, synced)
+
+    # Remove local files whose keys no longer exist in the bucket
+    for file_name in os.listdir(local_folder):
+        if file_name not in remote_files:
+            os.remove(os.path.join(local_folder, file_name))
+            print(f"File {file_name} removed from {local_folder}")
+
+
+def local_etag(file_path, part_size):
+    # S3 reports the MD5 of the body as the ETag of a single-part upload, and the
+    # MD5 of the concatenated part digests plus "-<parts>" for a multipart one
+    part_digests = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+
+    if os.path.getsize(file_path) < part_size:
+        return part_digests[0].hex() if part_digests else hashlib.md5(b'').hexdigest()
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f"-{len(part_digests)}"
+
+
+def transfer_config(part_size, max_concurrency):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency,
+    )
+
+
+def upload_files(s3_client, local_folder, s3_folder, workers, part_size, max_concurrency):
+    config = transfer_config(part_size, max_concurrency)
+
+    # One listing pass gives the ETag of every object already in the bucket
+    remote_etags = {obj['Key']: obj['ETag'].strip('"') for obj in list_objects(s3_client, s3_folder + "/")}
+
+    def upload_file(file_name):
+        file_path = os.path.join(local_folder, file_name)
+        object_name = f'{s3_folder}/{file_name}'  # The name of the file in the bucket, including the folder
+
+        if remote_etags.get(object_name) == local_etag(file_path, part_size):
+            return None
+
+        # Upload the file
+        s3_client.upload_file(file_path, bucket_name, object_name, Config=config)
+        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+        return os.path.getsize(file_path)
+
+    start_time = time.time()
+    count = 0
+    skipped = 0
+    total_bytes = 0
+    # Temporary files of a run that stopped mid-write are not outputs
+    file_names = [file_name for file_name in os.listdir(local_folder) if not file_name.endswith(".tmp")]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size in executor.map(upload_file, file_names):
+            if size is None:
+                skipped += 1
+            else:
+                count += 1
+                total_bytes += size
+
+    report_throughput("Uploaded", count, total_bytes, time.time() - start_time)
+    print(f"Skipped {skipped} unchanged files")
+
+
+def download(workers=WORKERS):
     print("download")
 
-    # Clear
-    shutil.rmtree(text_translated, ignore_errors=True, onerror=None)
     makedirs()
 
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
+    s3_client = get_client('s3')
 
     # List objects in the bucket with the specified prefix
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=text_translated + "/")
+    blobs = (obj for obj in list_objects(s3_client, text_translated + "/")
+             if obj['Key'].endswith(".txt"))
 
-    for obj in response.get('Contents', []):
-        print(obj['Key'])
-        if obj['Key'].endswith(".txt"):
-            local_file_name = os.path.join(text_translated, os.path.basename(obj['Key']))
-            print("local_file_name:", local_file_name)
-            s3_client.download_file(bucket_name, obj['Key'], local_file_name)
+    sync_objects(s3_client, blobs, text_translated, workers)
 
     
 
-def synthesis():
+# Size of the HTTP connection pool of the ElevenLabs session, set from the CLI in main()
+http_pool_size = TTS_CONCURRENCY
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    # One session for every request so connections and TLS sessions are reused
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def tts_data(text, previous_text=None, next_text=None):
+    # Set up the data payload for the API request, including the text and voice settings
+    data = {
+        "text": text,
+        "model_id": "eleven_multilingual_v2",
+        "voice_settings": {
+            "stability": 0.5,
+            "similarity_boost": 0.8,
+            "style": 0.0,
+            "use_speaker_boost": True
+        }
+    }
+    # The neighbouring chunks keep the intonation continuous across chunk boundaries
+    if previous_text:
+        data["previous_text"] = previous_text
+    if next_text:
+        data["next_text"] = next_text
+    return data
+
+
+def tts_request(text, previous_text=None, next_text=None):
+    # Construct the URL for the Text-to-Speech API request
+    tts_url = f"{ELEVENLABS_BASE_URL}/v1/text-to-speech/{VOICE_ID}/stream"
+
+    # Set up headers for the API request, including the API key for authentication
+    headers = {
+        "Accept": "application/json",
+        "xi-api-key": get_xi_api_key()
+    }
+    data = tts_data(text, previous_text, next_text)
+
+    # Make the POST request to the TTS API with headers and data, enabling streaming response
+    return get_session().post(tts_url, headers=headers, json=data, stream=True, timeout=(10, 300))
+
+
+class AudioCache:
+    # Synthesized audio keyed by a hash of everything that determines it. Entries are
+    # files in a local folder, evicted least recently used first, with an optional S3
+    # prefix shared by every container as a second tier behind it
+    def __init__(self, folder, max_bytes, s3_prefix=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.s3_prefix = s3_prefix
+        self.hits = {"local": 0, "s3": 0}
+        self.misses = 0
+        self.characters = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.folder, key + ".mp3")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data, "local"
+        except OSError:
+            pass
+
+        if self.s3_prefix is None:
+            return None, None
+        s3_client = get_client('s3')
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=f"{self.s3_prefix}/{key}.mp3")
+        except s3_client.exceptions.NoSuchKey:
+            return None, None
+        data = response['Body'].read()
+        self.put_local(key, data)
+        return data, "s3"
+
+    def lookup(self, key, characters):
+        # characters is the length of the text, counted as saved on a hit
+        data, tier = self.get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits[tier] += 1
+                self.characters += characters
+        return data
+
+    def put_local(self, key, data):
+        # Threads storing the same audio at once each write their own temporary file
+        path = os.path.join(self.folder, key + ".mp3")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, key, data):
+        self.put_local(key, data)
+        if self.s3_prefix is not None:
+            get_client('s3').put_object(Bucket=bucket_name, Key=f"{self.s3_prefix}/{key}.mp3", Body=data)
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.folder):
+            stat = os.stat(os.path.join(self.folder, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        # Drop least recently used entries until the local folder fits
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.folder, file_name))
+            total_bytes -= size
+
+    def report(self):
+        total = max(sum(self.hits.values()) + self.misses, 1)
+        print(f"Audio cache: {self.hits['local']} local hits, {self.hits['s3']} S3 hits, {self.misses} misses "
+              f"({100 * sum(self.hits.values()) / total:.0f}% hit rate), {self.characters} characters not sent")
+
+
+# Set from the CLI in main(), None disables caching
+audio_cache = None
+
+
+def make_cache(backend, max_mb):
+    if backend == "local":
+        return AudioCache(cache_folder, max_mb * 1024 * 1024)
+    if backend == "s3":
+        return AudioCache(cache_folder, max_mb * 1024 * 1024, s3_prefix=cache_folder.lstrip("."))
+    return None
+
+
+def normalize_text(text):
+    # Unicode forms and whitespace don't change the speech
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(request):
+    # Hash of the provider, voice, model, settings and normalized text of a request
+    request = {name: normalize_text(value) if name.endswith("text") and value else value
+               for name, value in request.items()}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ChunkStream(io.RawIOBase):
+    # Read-only file object over an iterator of byte chunks, so a streamed HTTP
+    # response can be handed to upload_fileobj without touching disk
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.leftover = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.leftover:
+            try:
+                self.leftover = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        return size
+
+
+def split_text(text, max_chars):
+    # Pack whole sentences into chunks of at most max_chars, a longer sentence is split between words
+    chunks = []
+    current = ""
+    for sentence in sentence_end.split(text.strip()):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# Layer III frame header tables, bitrates in kbps
+MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def mp3_frames(data):
+    # Yield the audio frames of an mp3, skipping ID3 tags and the Xing/Info header frame,
+    # so the frames of several responses join into one stream without re-encoding
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f)
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+
+    first = True
+    while pos + 4 <= len(data):
+        header = data[pos:pos + 4]
+        version = (header[1] >> 3) & 3
+        layer = (header[1] >> 1) & 3
+        bitrate_index = header[2] >> 4
+        rate_index = (header[2] >> 2) & 3
+        if (header[0] != 0xFF or header[1] & 0xE0 != 0xE0 or version == 1 or layer != 1
+                or bitrate_index in (0, 15) or rate_index == 3):
+            # Not a frame header, look for the next sync word
+            pos += 1
+            continue
+
+        sample_rate = SAMPLE_RATES[version][rate_index]
+        padding = (header[2] >> 1) & 1
+        if version == 3:
+            length = 144000 * MPEG1_BITRATES[bitrate_index] // sample_rate + padding
+        else:
+            length = 72000 * MPEG2_BITRATES[bitrate_index] // sample_rate + padding
+        frame = data[pos:pos + length]
+        if len(frame) < length:
+            break
+        if not (first and (b"Xing" in frame[:64] or b"Info" in frame[:64])):
+            yield frame
+        first = False
+        pos += length
+
+
+class Governor:
+    # AIMD control of the requests in flight plus a sliding window of characters sent,
+    # shared by all synthesis threads. Every change of the limit is logged
+    def __init__(self, max_limit, char_quota=CHAR_QUOTA, quota_window=QUOTA_WINDOW, latency_target=LATENCY_TARGET):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.char_quota = char_quota
+        self.quota_window = quota_window
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.sent = deque()
+        self.sent_chars = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.failures = 0
+        self.throttles = 0
+        self.quota_waiters = 0
+        self.counts = {"ok": 0, "throttled": 0, "errors": 0, "slow": 0}
+        self.condition = threading.Condition()
+
+    def acquire(self, chars):
+        # Returns the start time to pass back to release()
+        with self.condition:
+            logged = False
+            while True:
+                now = time.monotonic()
+                while self.sent and now - self.sent[0][0] > self.quota_window:
+                    self.sent_chars -= self.sent.popleft()[1]
+
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.in_flight >= int(self.limit):
+                    self.condition.wait()
+                elif self.char_quota and self.sent and self.sent_chars + chars > self.char_quota:
+                    wait = self.sent[0][0] + self.quota_window - now
+                    if not logged:
+                        # Logged by the first thread to wait, the others queue up behind it
+                        if not self.quota_waiters:
+                            print(f"Governor: {self.sent_chars} characters sent in the last {self.quota_window}s, "
+                                  f"waiting {wait:.1f}s for quota")
+                        self.quota_waiters += 1
+                        logged = True
+                    self.condition.wait(wait)
+                else:
+                    break
+
+            if logged:
+                self.quota_waiters -= 1
+            self.in_flight += 1
+            self.sent.append((now, chars))
+            self.sent_chars += chars
+            return now
+
+    def release(self, started, status, first_byte=None, retry_after=None):
+        # status is the HTTP status, None for a dropped connection. Returns the seconds
+        # everyone pauses for because of this response, 0 for none
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            old_limit = int(self.limit)
+            reason = None
+            delay = 0
+
+            if status == 429 and not retry_after:
+                # Too many requests at once, fewer in flight is usually enough. Once down to
+                # one request, or when 429s keep coming, wait before sending again as well
+                self.counts["throttled"] += 1
+                self.throttles += 1
+                reason = "HTTP 429"
+                if old_limit <= 1 or self.throttles > 1:
+                    delay = min(2 ** self.throttles, 60) * (0.5 + random.random() / 2)
+                    self.paused_until = max(self.paused_until, now + delay)
+                    reason = f"HTTP 429, pausing {delay:.1f}s"
+            elif status is None or status == 429 or status >= 500:
+                self.counts["throttled" if status == 429 else "errors"] += 1
+                self.failures += 1
+                # Everyone waits for the server to recover, not just the request that failed
+                delay = float(retry_after) if retry_after else min(2 ** self.failures, 60) * (0.5 + random.random() / 2)
+                self.paused_until = max(self.paused_until, now + delay)
+                reason = f"HTTP {status or 'connection error'}, pausing {delay:.1f}s"
+            elif status < 400:
+                self.failures = 0
+                self.throttles = 0
+                if first_byte is not None and first_byte > self.latency_target:
+                    self.counts["slow"] += 1
+                    reason = f"first byte after {first_byte:.1f}s"
+                else:
+                    self.counts["ok"] += 1
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            # Requests sent before the last decrease saw the old limit, only back off once for them
+            if reason and started >= self.last_decrease:
+                self.limit = max(1.0, self.limit / 2)
+                self.last_decrease = now
+            if int(self.limit) != old_limit:
+                print(f"Governor: {reason or 'requests succeeding'}, in-flight limit {old_limit} -> {int(self.limit)}")
+            elif reason:
+                print(f"Governor: {reason}")
+            self.condition.notify_all()
+            return delay
+
+    def report(self):
+        print(f"Governor: {self.counts['ok']} ok, {self.counts['slow']} slow, {self.counts['throttled']} throttled, "
+              f"{self.counts['errors']} errors; final in-flight limit {int(self.limit)}/{self.max_limit}")
+
+
+def synthesize_chunk(chunks, index, chunk_size, governor):
+    # Returns (mp3 bytes, seconds to first byte, seconds in total) for chunks[index],
+    # the times are None when the audio came from the cache.
+    # On rate limits, server errors and dropped connections the chunk goes back in
+    # line behind the governor, the other chunks of the text are kept
+    import requests
+
+    previous_text = chunks[index - 1] if index > 0 else None
+    next_text = chunks[index + 1] if index + 1 < len(chunks) else None
+
+    if audio_cache is not None:
+        key = cache_key({"provider": "elevenlabs", "voice_id": VOICE_ID,
+                         **tts_data(chunks[index], previous_text, next_text)})
+        data = audio_cache.lookup(key, len(chunks[index]))
+        if data is not None:
+            return data, None, None
+
+    attempts = 0
+    throttled = 0
+    while True:
+        started = governor.acquire(len(chunks[index]))
+        start_time = time.time()
+        status = None
+        retry_after = None
+        try:
+            response = tts_request(chunks[index], previous_text, next_text)
+            if response.ok:
+                first_byte = None
+                data = bytearray()
+                # Read the response in chunks
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if first_byte is None:
+                        first_byte = time.time() - start_time
+                    data += chunk
+                elapsed = time.time() - start_time
+                governor.release(started, response.status_code, first_byte or elapsed)
+                if audio_cache is not None:
+                    audio_cache.put(key, bytes(data))
+                return bytes(data), first_byte or elapsed, elapsed
+            status = response.status_code
+            retry_after = response.headers.get("retry-after")
+            error = f"HTTP {status}: {response.text}"
+        except requests.RequestException as e:
+            error = repr(e)
+        paused = governor.release(started, status, retry_after=retry_after)
+
+        if status is not None and status != 429 and status < 500:
+            raise RuntimeError(f"Chunk {index + 1}/{len(chunks)} failed: {error}")
+
+        # Being throttled is expected while the governor finds the limit, errors are not.
+        # A 429 only counts against the chunk once the governor pauses for it
+        if status == 429:
+            throttled += 1 if paused else 0
+        else:
+            attempts += 1
+        if attempts > CHUNK_RETRIES or throttled > MAX_THROTTLED:
+            raise RuntimeError(f"Chunk {index + 1}/{len(chunks)} failed {attempts + throttled} times: {error}")
+        print(f"Chunk {index + 1}/{len(chunks)} failed ({error}), re-queued")
+
+
+def write_audio(text_file, futures):
+    # Join the chunks of one text in order and write the mp3 through a temporary file
+    uuid = text_file.replace(".txt", "")
+    audio_file = os.path.join(output_audios, uuid + ".mp3")
+    results = [future.result() for future in futures]
+
+    with open(audio_file + ".tmp", "wb") as f:
+        for data, _, _ in results:
+            for frame in mp3_frames(data):
+                f.write(frame)
+    os.replace(audio_file + ".tmp", audio_file)
+
+    # Inform the user of success
+    print(f"Audio stream saved successfully: {uuid}.mp3 from {len(results)} chunks, "
+          f"{os.path.getsize(audio_file) / 1024:.0f} KB")
+    return results
+
+
+def synthesis(concurrency=TTS_CONCURRENCY, chunk_size=CHUNK_SIZE, max_chars=MAX_CHUNK_CHARS,
+              char_quota=CHAR_QUOTA, quota_window=QUOTA_WINDOW, latency_target=LATENCY_TARGET):
     print("synthesis")
     makedirs()
 
-    language_code = "es-ES" #"fr-FR"
+    # Text files that don't have audio yet
+    pending = [text_file for text_file in os.listdir(text_translated)
+               if not os.path.exists(os.path.join(output_audios, text_file.replace(".txt", ".mp3")))]
+
+    governor = Governor(concurrency, char_quota, quota_window, latency_target)
+
+    start_time = time.time()
+    results = []
+    written = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        def finish(text_file, futures):
+            nonlocal written, failed
+            try:
+                results.extend(write_audio(text_file, futures))
+                written += 1
+            except Exception as e:
+                failed += 1
+                print(f"Failed to synthesize {text_file}: {e}")
+
+        # Chunks of the next texts are queued while earlier texts finish, with about two
+        # chunks per worker in flight so finished audio doesn't pile up in memory
+        window = deque()
+        for text_file in pending:
+            print("uuid:", text_file.replace(".txt", ""))
+            with open(os.path.join(text_translated, text_file)) as f:
+                chunks = split_text(f.read(), max_chars)
+            if not chunks:
+                # Nothing to voice, an empty mp3 would be taken as done by later runs
+                failed += 1
+                print(f"Failed to synthesize {text_file}: no text")
+                continue
+            futures = [executor.submit(synthesize_chunk, chunks, i, chunk_size, governor) for i in range(len(chunks))]
+            window.append((text_file, futures))
+            while len(window) > 1 and sum(len(futures) for _, futures in window) > concurrency * 2:
+                finish(*window.popleft())
+        while window:
+            finish(*window.popleft())
+    elapsed = time.time() - start_time
+
+    report_throughput("Synthesized", written, sum(len(data) for data, _, _ in results), elapsed)
+    requested = [result for result in results if result[1] is not None]
+    if requested:
+        latencies = sorted(first_byte for _, first_byte, _ in requested)
+        durations = sorted(duration for _, _, duration in requested)
+        print(f"{len(requested)} chunks requested: first byte p50 {latencies[len(latencies) // 2]:.2f}s, "
+              f"max {latencies[-1]:.2f}s; request p50 {durations[len(durations) // 2]:.2f}s, "
+              f"max {durations[-1]:.2f}s; {failed} files failed")
+    governor.report()
+
+    if audio_cache is not None:
+        audio_cache.report()
+        audio_cache.evict()
+
+def stream(part_size=PART_SIZE, max_concurrency=MAX_CONCURRENCY, chunk_size=CHUNK_SIZE):
+    # Read translated text straight from S3 and pipe the audio stream straight back, no local folders
+    print("stream")
+
+    s3_client = get_client('s3')
+    config = transfer_config(part_size, max_concurrency)
+
+    # Texts that already have audio in the bucket are skipped
+    done = {obj['Key'].split("/")[-1] for obj in list_objects(s3_client, "output_audios/")}
+
+    for obj in list_objects(s3_client, text_translated + "/"):
+        if not obj['Key'].endswith(".txt"):
+            continue
+        uuid = obj['Key'].split("/")[-1].replace(".txt", "")
+        if uuid + ".mp3" in done:
+            continue
 
-    # Get the list of text file
-    text_files = os.listdir(text_translated)
+        response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
+        text = response['Body'].read().decode("utf-8")
 
-    for text_file in text_files:
-        uuid = text_file.replace(".txt", "")
-        print("uuid:", uuid)
-        file_path = os.path.join(text_translated, text_file)
-        audio_file = os.path.join(output_audios, uuid + ".mp3")
-    
-        if os.path.exists(audio_file):
-            continue
-        
-        with open(file_path) as f:
-            TEXT_TO_SPEAK = f.read()
-    
-        OUTPUT_PATH = audio_file
-    
-        # Construct the URL for the Text-to-Speech API request
-        tts_url = f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}/stream"
-    
-        # Set up headers for the API request, including the API key for authentication
-        headers = {
-            "Accept": "application/json",
-            "xi-api-key": XI_API_KEY
-        }
-    
-        # Set up the data payload for the API request, including the text and voice settings
-        data = {
-            "text": TEXT_TO_SPEAK,
-            "model_id": "eleven_multilingual_v2",
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.8,
-                "style": 0.0,
-                "use_speaker_boost": True
-            }
-        }
-    
-        # Make the POST request to the TTS API with headers and data, enabling streaming response
-        response = requests.post(tts_url, headers=headers, json=data, stream=True)
-    
-        # Check if the request was successful
-        if response.ok:
-            # Open the output file in write-binary mode
-            with open(OUTPUT_PATH, "wb") as f:
-                # Read the response in chunks and write to the file
-                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                    f.write(chunk)
-            # Inform the user of success
-            print("Audio stream saved successfully.")
-        else:
+        response = tts_request(text)
+        if not response.ok:
             # Print the error message if the request was not successful
             print(response.text)
+            continue
+
+        # upload_fileobj switches to a multipart upload once the stream passes the part size
+        audio_stream = io.BufferedReader(ChunkStream(response.iter_content(chunk_size=chunk_size)))
+        object_name = f"output_audios/{uuid}.mp3"
+        s3_client.upload_fileobj(audio_stream, bucket_name, object_name, Config=config)
+        print(f"Audio for {obj['Key']} uploaded to {bucket_name}/{object_name}")
+
 
-def upload():
+def upload(workers=WORKERS, part_size=PART_SIZE, max_concurrency=MAX_CONCURRENCY):
     ## reads from output_audios_pp folder and uploads to s3 bucket output_audios folder
     print("upload")
     makedirs()
 
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
-
-    # Get the list of files
-    audio_files = os.listdir(output_audios)
-
-    for audio_file in audio_files:
-        file_path = os.path.join(output_audios, audio_file)
+    s3_client = get_client('s3')
 
-        # The key is the path in the S3 bucket where the file will be stored
-        s3_key = os.path.join("output_audios", audio_file)
-
-        print("s3_key:", s3_key)
-        print("file_path:", file_path)
-
-        # Upload the file
-        s3_client.upload_file(file_path, bucket_name, s3_key)
+    upload_files(s3_client, output_audios, "output_audios", workers, part_size, max_concurrency)
 
     print("Upload completed.")
     
@@ -172,12 +850,22 @@ def upload():
 def main(args=None):
     print("Args:", args)
 
+    global pool_connections, http_pool_size, audio_cache
+    pool_connections = args.workers * args.max_concurrency
+    http_pool_size = args.concurrency
+    audio_cache = make_cache(args.cache, args.cache_max_mb)
+
+    if args.stream:
+        stream(part_size=args.part_size * 1024 * 1024, max_concurrency=args.max_concurrency,
+               chunk_size=args.chunk_size * 1024)
     if args.download:
-        download()
+        download(workers=args.workers)
     if args.synthesis:
-        synthesis()
+        synthesis(concurrency=args.concurrency, chunk_size=args.chunk_size * 1024,
+                  max_chars=args.max_chunk_chars, char_quota=args.char_quota,
+                  quota_window=args.quota_window, latency_target=args.latency_target)
     if args.upload:
-        upload()
+        upload(workers=args.workers, part_size=args.part_size * 1024 * 1024, max_concurrency=args.max_concurrency)
 
 
 if __name__ == "__main__":
@@ -200,6 +888,91 @@ if __name__ == "__main__":
         "-u", "--upload", action="store_true", help="Upload audio file to GCS bucket"
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of concurrent S3 transfers",
+    )
+
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=PART_SIZE // (1024 * 1024),
+        help="Multipart upload part size in MB",
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Number of concurrent part uploads per file",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=TTS_CONCURRENCY,
+        help="Most concurrent text to speech requests",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE // 1024,
+        help="Size of each read from the audio stream in KB",
+    )
+
+    parser.add_argument(
+        "--max-chunk-chars",
+        type=int,
+        default=MAX_CHUNK_CHARS,
+        help="Longest piece of text sent in one request, texts are split at sentence ends",
+    )
+
+    parser.add_argument(
+        "--char-quota",
+        type=int,
+        default=CHAR_QUOTA,
+        help="Characters allowed per quota window, 0 for no limit",
+    )
+
+    parser.add_argument(
+        "--quota-window",
+        type=int,
+        default=QUOTA_WINDOW,
+        help="Length of the character quota window in seconds",
+    )
+
+    parser.add_argument(
+        "--latency-target",
+        type=float,
+        default=LATENCY_TARGET,
+        help="Seconds to first byte above which fewer requests are sent at once",
+    )
+
+    parser.add_argument(
+        "--cache",
+        choices=["local", "s3", "off"],
+        default="local",
+        help="Where to cache synthesized audio, s3 adds the bucket behind the local cache",
+    )
+
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=CACHE_MAX_MB,
+        help="Size limit of the local audio cache in MB",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream inputs from S3 through the stage and back to S3 without local files",
+    )
+
     args = parser.parse_args()
 
     main(args)
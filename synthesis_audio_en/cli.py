@@ -2,133 +2,860 @@
 Module that contains the command line app.
 """
 import os
+import hashlib
+import json
 import argparse
 import shutil
-import boto3
+import time
+import random
+import threading
+import unicodedata
+from xml.sax.saxutils import escape
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import csv
 
 bucket_name = 'megapipeline-s3bucket'
 text_paragraphs = "text_paragraphs"
 text_audios = "text_audios"
+cache_folder = ".tts_cache"
+tasks_state_file = ".polly_tasks.json"
+# Bucket folder the synthesis tasks write to before the audio moves to text_audios/
+task_folder = "polly_tasks"
+
+# Number of concurrent S3 transfers
+WORKERS = 8
+
+# Multipart upload settings, the 8 MB part size matches the boto3 default so
+# ETags of objects uploaded by earlier runs still compare equal
+PART_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 10
+
+# Polly voice settings of every request
+VOICE_ID = "Joanna"
+OUTPUT_FORMAT = "mp3"
+
+# Concurrent synthesize_speech calls and the rate they are sent at, Polly throttles
+# an account above its transactions per second quota
+POLLY_CONCURRENCY = 8
+POLLY_RPS = 20
+# Attempts per text when Polly keeps answering ThrottlingException
+SYNTHESIS_RETRIES = 6
+
+# With --pack short texts share one SSML request of at most PACK_MAX_CHARS billed
+# characters (SSML_MAX_CHARS with the tags), separated by a pause and a <mark> that
+# the speech marks of the request time, so the mp3 can be cut back into one file per text
+PACK_MAX_CHARS = 3000
+SSML_MAX_CHARS = 6000
+PACK_BREAK = "500ms"
+
+# synthesize_speech takes at most 3000 characters, longer texts go to asynchronous
+# synthesis tasks that write the mp3 straight to the bucket
+SYNC_MAX_CHARS = 3000
+TASK_POLL_INTERVAL = 5
+# Status checks of one task that may fail in a row before it is left for the next run
+TASK_CHECK_RETRIES = 5
+
+# Audio of text voiced before is reused, the local cache keeps the most recently
+# used entries up to CACHE_MAX_MB
+CACHE_MAX_MB = 512
 
 def makedirs():
     os.makedirs(text_paragraphs, exist_ok=True)
     os.makedirs(text_audios, exist_ok=True)
     
-# Path to your CSV file
-csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
-
-# Read the CSV file
-with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
-    reader = csv.DictReader(file)
-    credentials = next(reader)  # Assuming the CSV has only one row of credentials
-
-# Extract the access key and secret key
-access_key = credentials['Access key ID']
-secret_key = credentials['Secret access key']
-
-# Create a Polly client
-#polly_client = boto3.client('polly', region_name='us-east-1')
-polly_client = boto3.client(
-    'polly',
-    aws_access_key_id=access_key,
-    aws_secret_access_key=secret_key,
-    region_name='us-east-1'
-)
-
-def download():
+@lru_cache(maxsize=None)
+def get_credentials():
+    # Read on first use so --help and steps that never call AWS don't need the file
+    # Path to your CSV file
+    csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
+
+    # Read the CSV file
+    with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        credentials = next(reader)  # Assuming the CSV has only one row of credentials
+
+    # Extract the access key and secret key
+    return credentials['Access key ID'], credentials['Secret access key']
+
+
+# Size of the HTTP connection pool of every client, set from the CLI in main()
+pool_connections = WORKERS * MAX_CONCURRENCY
+
+# One session and one client per (service, region), created on first use and
+# shared by every step so a download+process+upload run keeps its connections warm
+boto3_session = None
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service, region_name=None):
+    global boto3_session
+    import boto3
+    from botocore.config import Config
+
+    with clients_lock:
+        if boto3_session is None:
+            access_key, secret_key = get_credentials()
+            # Create a boto3 session
+            boto3_session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+        if (service, region_name) not in clients:
+            clients[(service, region_name)] = boto3_session.client(
+                service,
+                region_name=region_name,
+                config=Config(max_pool_connections=pool_connections),
+            )
+        return clients[(service, region_name)]
+
+
+def list_objects(s3_client, prefix):
+    # Page through the prefix, list_objects_v2 returns at most 1000 keys per call
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def report_throughput(action, count, total_bytes, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    megabytes = total_bytes / (1024 * 1024)
+    print(f"{action} {count} files ({megabytes:.2f} MB) in {elapsed:.2f}s: "
+          f"{count / elapsed:.1f} objects/s, {megabytes / elapsed:.2f} MB/s")
+
+
+def download_objects(s3_client, objects, local_folder, workers, on_downloaded=None):
+    # Bound the number of queued downloads so the listing generator is only
+    # consumed as fast as the pool drains it
+    def download_object(obj):
+        local_file_path = os.path.join(local_folder, obj['Key'].split("/")[-1])
+        s3_client.download_file(bucket_name, obj['Key'], local_file_path)
+        print(f"File {obj['Key']} downloaded to {local_file_path}")
+        return obj
+
+    start_time = time.time()
+    count = 0
+    total_bytes = 0
+
+    def finished(future):
+        nonlocal count, total_bytes
+        obj = future.result()
+        count += 1
+        total_bytes += obj['Size']
+        if on_downloaded is not None:
+            on_downloaded(obj)
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for obj in objects:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future)
+            pending.add(executor.submit(download_object, obj))
+        for future in as_completed(pending):
+            finished(future)
+
+    report_throughput("Downloaded", count, total_bytes, time.time() - start_time)
+
+
+def manifest_path(local_folder):
+    # Kept next to (not inside) the folder so os.listdir() only sees data files
+    return f".{local_folder}.manifest.json"
+
+
+def load_manifest(local_folder):
+    path = manifest_path(local_folder)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(local_folder, manifest):
+    path = manifest_path(local_folder)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def sync_objects(s3_client, objects, local_folder, workers):
+    # Mirror the listed objects into local_folder, fetching only keys whose
+    # ETag, size or last-modified changed since the previous sync
+    manifest = load_manifest(local_folder)
+    synced = {}
+    remote_files = set()
+
+    def entry(obj):
+        return {
+            'key': obj['Key'],
+            'etag': obj['ETag'],
+            'size': obj['Size'],
+            'last_modified': obj['LastModified'].isoformat(),
+        }
+
+    def changed_objects():
+        for obj in objects:
+            file_name = obj['Key'].split("/")[-1]
+            remote_files.add(file_name)
+            if manifest.get(file_name) == entry(obj) and os.path.exists(os.path.join(local_folder, file_name)):
+                synced[file_name] = manifest[file_name]
+            else:
+                yield obj
+
+    def on_downloaded(obj):
+        synced[obj['Key'].split("/")[-1]] = entry(obj)
+
+    try:
+        download_objects(s3_client, changed_objects(), local_folder, workers, on_downloaded)
+    finally:
+        save_manifest(local_folder, synced)
+
+    # Remove local files whose keys no longer exist in the bucket
+    for file_name in os.listdir(local_folder):
+        if file_name not in remote_files:
+            os.remove(os.path.join(local_folder, file_name))
+            print(f"File {file_name} removed from {local_folder}")
+
+
+def local_etag(file_path, part_size):
+    # S3 reports the MD5 of the body as the ETag of a single-part upload, and the
+    # MD5 of the concatenated part digests plus "-<parts>" for a multipart one
+    part_digests = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+
+    if os.path.getsize(file_path) < part_size:
+        return part_digests[0].hex() if part_digests else hashlib.md5(b'').hexdigest()
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f"-{len(part_digests)}"
+
+
+def transfer_config(part_size, max_concurrency):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency,
+    )
+
+
+def upload_files(s3_client, local_folder, s3_folder, workers, part_size, max_concurrency):
+    config = transfer_config(part_size, max_concurrency)
+
+    # One listing pass gives the ETag of every object already in the bucket
+    remote_etags = {obj['Key']: obj['ETag'].strip('"') for obj in list_objects(s3_client, s3_folder + "/")}
+
+    def upload_file(file_name):
+        file_path = os.path.join(local_folder, file_name)
+        object_name = f'{s3_folder}/{file_name}'  # The name of the file in the bucket, including the folder
+
+        if remote_etags.get(object_name) == local_etag(file_path, part_size):
+            return None
+
+        # Upload the file
+        s3_client.upload_file(file_path, bucket_name, object_name, Config=config)
+        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+        return os.path.getsize(file_path)
+
+    start_time = time.time()
+    count = 0
+    skipped = 0
+    total_bytes = 0
+    # Temporary files of a run that stopped mid-write are not outputs
+    file_names = [file_name for file_name in os.listdir(local_folder) if not file_name.endswith(".tmp")]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size in executor.map(upload_file, file_names):
+            if size is None:
+                skipped += 1
+            else:
+                count += 1
+                total_bytes += size
+
+    report_throughput("Uploaded", count, total_bytes, time.time() - start_time)
+    print(f"Skipped {skipped} unchanged files")
+
+
+def download(workers=WORKERS):
     print("download")
 
-    # Clear
-    shutil.rmtree(text_paragraphs, ignore_errors=True, onerror=None)
     makedirs()
     
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
+    s3_client = get_client('s3')
 
     # List files in the specified folder
     folder_name = 'text_paragraphs/'  # Replace with your folder name in S3
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=folder_name)
-
-    blobs = []
-    if 'Contents' in response:
-        for obj in response['Contents']:
-            blobs.append(obj['Key'])
-    else:
-        print(f"No files found in folder {folder_name}")
-    
-    for blob in blobs:
-        if not blob.endswith("/"):
-            # Download the file
-            local_file_path = os.path.join(folder_name, blob.split("/")[-1])
-            s3_client.download_file(bucket_name, blob, local_file_path)
-            print(f"File {blob} downloaded to {local_file_path}")
-
+    blobs = (obj for obj in list_objects(s3_client, folder_name)
+             if not obj['Key'].endswith("/"))
+
+    sync_objects(s3_client, blobs, text_paragraphs, workers)
+
+
+class AudioCache:
+    # Synthesized audio keyed by a hash of everything that determines it. Entries are
+    # files in a local folder, evicted least recently used first, with an optional S3
+    # prefix shared by every container as a second tier behind it
+    def __init__(self, folder, max_bytes, s3_prefix=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.s3_prefix = s3_prefix
+        self.hits = {"local": 0, "s3": 0}
+        self.misses = 0
+        self.characters = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.folder, key + ".mp3")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data, "local"
+        except OSError:
+            pass
+
+        if self.s3_prefix is None:
+            return None, None
+        s3_client = get_client('s3')
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=f"{self.s3_prefix}/{key}.mp3")
+        except s3_client.exceptions.NoSuchKey:
+            return None, None
+        data = response['Body'].read()
+        self.put_local(key, data)
+        return data, "s3"
+
+    def lookup(self, key, characters):
+        # characters is the length of the text, counted as saved on a hit
+        data, tier = self.get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits[tier] += 1
+                self.characters += characters
+        return data
+
+    def put_local(self, key, data):
+        # Threads storing the same audio at once each write their own temporary file
+        path = os.path.join(self.folder, key + ".mp3")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, key, data):
+        self.put_local(key, data)
+        if self.s3_prefix is not None:
+            get_client('s3').put_object(Bucket=bucket_name, Key=f"{self.s3_prefix}/{key}.mp3", Body=data)
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.folder):
+            stat = os.stat(os.path.join(self.folder, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        # Drop least recently used entries until the local folder fits
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.folder, file_name))
+            total_bytes -= size
+
+    def report(self):
+        total = max(sum(self.hits.values()) + self.misses, 1)
+        print(f"Audio cache: {self.hits['local']} local hits, {self.hits['s3']} S3 hits, {self.misses} misses "
+              f"({100 * sum(self.hits.values()) / total:.0f}% hit rate), {self.characters} characters not sent")
+
+
+# Set from the CLI in main(), None disables caching
+audio_cache = None
+
+
+def make_cache(backend, max_mb):
+    if backend == "local":
+        return AudioCache(cache_folder, max_mb * 1024 * 1024)
+    if backend == "s3":
+        return AudioCache(cache_folder, max_mb * 1024 * 1024, s3_prefix=cache_folder.lstrip("."))
+    return None
+
+
+def normalize_text(text):
+    # Unicode forms and whitespace don't change the speech
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(request):
+    # Hash of the provider, voice, model, settings and normalized text of a request
+    request = {name: normalize_text(value) if name.endswith("text") and value else value
+               for name, value in request.items()}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class RateLimiter:
+    # Spaces requests evenly at rps per second across all synthesis threads. A throttled
+    # request pauses every thread, with a backoff that grows while throttling continues
+    def __init__(self, rps):
+        self.interval = 1 / rps if rps else 0
+        self.next_start = 0
+        self.paused_until = 0
+        self.failures = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start, self.paused_until)
+            self.next_start = start + self.interval
+        time.sleep(start - now)
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+
+    def backoff(self):
+        with self.lock:
+            self.failures += 1
+            self.throttled += 1
+            delay = min(2 ** self.failures, 60) * (0.5 + random.random() / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            return delay
+
+
+def write_atomic(file_path, data):
+    # Audio is written next to its final name and renamed into place, so a crash never
+    # leaves a truncated mp3 that later runs would take as done
+    tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as out:
+        if isinstance(data, bytes):
+            out.write(data)
+        else:
+            # Copy the response stream to the output file in chunks
+            shutil.copyfileobj(data, out)
+    os.replace(tmp_path, file_path)
+
+
+def polly_request(polly_client, limiter, label, method="synthesize_speech", **params):
+    # A Polly call, synthesize_speech by default, behind the rate limiter and retried
+    # while Polly throttles
+    from botocore.exceptions import ClientError
+
+    for attempt in range(SYNTHESIS_RETRIES):
+        limiter.acquire()
+        try:
+            response = getattr(polly_client, method)(VoiceId=VOICE_ID, **params)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ThrottlingException" or attempt == SYNTHESIS_RETRIES - 1:
+                raise
+            print(f"Polly throttled {label}, pausing {limiter.backoff():.1f}s")
+            continue
+        limiter.succeeded()
+        return response
+
+
+def text_cache_key(input_text):
+    if audio_cache is None:
+        return None
+    return cache_key({"provider": "polly", "voice_id": VOICE_ID, "output_format": OUTPUT_FORMAT,
+                      "text": input_text})
+
+
+def save_audio(uuid, audio_file, data, key=None):
+    # data is the mp3 bytes or, with caching off, the response stream
+    if key is not None:
+        audio_cache.put(key, data)
+    write_atomic(audio_file, data)
+    print(f"Audio for {uuid} written to {audio_file}")
+
+
+def synthesize_text(polly_client, limiter, uuid, input_text, audio_file):
+    # Returns (characters sent to Polly, requests made), nothing is sent on a cache hit
+    key = text_cache_key(input_text)
+    if key is not None:
+        data = audio_cache.lookup(key, len(input_text))
+        if data is not None:
+            write_atomic(audio_file, data)
+            return 0, 0
+
+    # Call the Polly API to synthesize speech
+    response = polly_request(polly_client, limiter, uuid, Text=input_text, OutputFormat=OUTPUT_FORMAT)
+    save_audio(uuid, audio_file, response["AudioStream"].read() if key else response["AudioStream"], key)
+    return len(input_text), 1
+
+
+def pack_texts(texts, max_chars=PACK_MAX_CHARS):
+    # Group consecutive (uuid, text, audio_file) into lists that fit one SSML request
+    pack = []
+    chars = 0
+    ssml_chars = len("<speak></speak>")
+    for item in texts:
+        item_ssml_chars = len(f'<break time="{PACK_BREAK}"/><mark name="{len(pack)}"/>') + len(escape(item[1]))
+        if pack and (chars + len(item[1]) > max_chars or ssml_chars + item_ssml_chars > SSML_MAX_CHARS):
+            yield pack
+            pack = []
+            chars = 0
+            ssml_chars = len("<speak></speak>")
+        pack.append(item)
+        chars += len(item[1])
+        ssml_chars += item_ssml_chars
+    if pack:
+        yield pack
+
+
+def pack_ssml(input_texts):
+    parts = []
+    for i, input_text in enumerate(input_texts):
+        if i:
+            parts.append(f'<break time="{PACK_BREAK}"/>')
+        parts.append(f'<mark name="{i}"/>{escape(input_text)}')
+    return "<speak>" + "".join(parts) + "</speak>"
+
+
+# Layer III frame header tables, bitrates in kbps
+MPEG1_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MPEG2_BITRATES = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def mp3_frames(data):
+    # Yield (frame, seconds) for the audio frames of an mp3, skipping ID3 tags and the
+    # Xing/Info header frame, so a stream can be cut at frame boundaries without re-encoding
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f)
+        pos = 10 + size + (10 if data[5] & 0x10 else 0)
+
+    first = True
+    while pos + 4 <= len(data):
+        header = data[pos:pos + 4]
+        version = (header[1] >> 3) & 3
+        layer = (header[1] >> 1) & 3
+        bitrate_index = header[2] >> 4
+        rate_index = (header[2] >> 2) & 3
+        if (header[0] != 0xFF or header[1] & 0xE0 != 0xE0 or version == 1 or layer != 1
+                or bitrate_index in (0, 15) or rate_index == 3):
+            # Not a frame header, look for the next sync word
+            pos += 1
+            continue
 
-def synthesis():
+        sample_rate = SAMPLE_RATES[version][rate_index]
+        padding = (header[2] >> 1) & 1
+        if version == 3:
+            length = 144000 * MPEG1_BITRATES[bitrate_index] // sample_rate + padding
+            samples = 1152
+        else:
+            length = 72000 * MPEG2_BITRATES[bitrate_index] // sample_rate + padding
+            samples = 576
+        frame = data[pos:pos + length]
+        if len(frame) < length:
+            break
+        if not (first and (b"Xing" in frame[:64] or b"Info" in frame[:64])):
+            yield frame, samples / sample_rate
+        first = False
+        pos += length
+
+
+def split_audio(data, times):
+    # Cut an mp3 at the frames nearest to each time in seconds, returns one part per time,
+    # the first part also keeps anything before the first time
+    frames = list(mp3_frames(data))
+    cuts = []
+    start = 0
+    index = 0
+    for cut_time in times[1:]:
+        while index < len(frames) and start + frames[index][1] / 2 < cut_time:
+            start += frames[index][1]
+            index += 1
+        cuts.append(index)
+
+    parts = []
+    for begin, end in zip([0] + cuts, cuts + [len(frames)]):
+        parts.append(b"".join(frame for frame, _ in frames[begin:end]))
+    return parts
+
+
+def synthesize_pack(polly_client, limiter, items):
+    # Voice several (uuid, text, audio_file) with one SSML request for the speech marks and
+    # one for the audio, then cut the audio at the marks. Returns (characters, requests)
+    misses = []
+    for uuid, input_text, audio_file in items:
+        key = text_cache_key(input_text)
+        if key is not None:
+            data = audio_cache.lookup(key, len(input_text))
+            if data is not None:
+                write_atomic(audio_file, data)
+                continue
+        misses.append((uuid, input_text, audio_file, key))
+
+    if not misses:
+        return 0, 0
+    if len(misses) == 1:
+        # Alone it is a plain request, speech marks would only add one
+        uuid, input_text, audio_file, key = misses[0]
+        response = polly_request(polly_client, limiter, uuid, Text=input_text, OutputFormat=OUTPUT_FORMAT)
+        save_audio(uuid, audio_file, response["AudioStream"].read(), key)
+        return len(input_text), 1
+
+    ssml = pack_ssml([input_text for _, input_text, _, _ in misses])
+    label = f"{len(misses)} packed texts ({misses[0][0]}, ...)"
+    response = polly_request(polly_client, limiter, label, Text=ssml, TextType="ssml",
+                             OutputFormat="json", SpeechMarkTypes=["ssml"])
+    marks = {}
+    for line in response["AudioStream"].read().decode("utf-8").splitlines():
+        if line.strip():
+            mark = json.loads(line)
+            marks[mark["value"]] = mark["time"] / 1000
+    response = polly_request(polly_client, limiter, label, Text=ssml, TextType="ssml", OutputFormat=OUTPUT_FORMAT)
+
+    parts = split_audio(response["AudioStream"].read(), [marks[str(i)] for i in range(len(misses))])
+    for (uuid, input_text, audio_file, key), data in zip(misses, parts):
+        save_audio(uuid, audio_file, data, key)
+    characters = sum(len(input_text) for _, input_text, _, _ in misses)
+    # Both requests bill the text
+    return 2 * characters, 2
+
+
+def load_tasks_state():
+    # uuid -> task id of the synthesis tasks still running, so a restart picks them up
+    if not os.path.exists(tasks_state_file):
+        return {}
+    with open(tasks_state_file) as f:
+        return json.load(f)
+
+
+def save_tasks_state(tasks):
+    with open(tasks_state_file + ".tmp", "w") as f:
+        json.dump(tasks, f)
+    os.replace(tasks_state_file + ".tmp", tasks_state_file)
+
+
+def start_task(polly_client, limiter, uuid, input_text):
+    # Returns the id of a Polly synthesis task writing the audio of input_text under task_folder/
+    response = polly_request(
+        polly_client,
+        limiter,
+        uuid,
+        method="start_speech_synthesis_task",
+        Text=input_text,
+        OutputFormat=OUTPUT_FORMAT,
+        OutputS3BucketName=bucket_name,
+        OutputS3KeyPrefix=f"{task_folder}/{uuid}.",
+    )
+    task_id = response["SynthesisTask"]["TaskId"]
+    print(f"Started synthesis task {task_id} for {uuid} ({len(input_text)} characters)")
+    return task_id
+
+
+def check_task(polly_client, s3_client, uuid, task_id):
+    # Returns the task status, once completed its audio has been moved to text_audios/
+    task = polly_client.get_speech_synthesis_task(TaskId=task_id)["SynthesisTask"]
+    if task["TaskStatus"] == "completed":
+        # Polly names the output <prefix><task id>.<format>, move it with a server side
+        # copy so the audio never passes through the container
+        source = f"{task_folder}/{uuid}.{task_id}.{OUTPUT_FORMAT}"
+        object_name = f"{text_audios}/{uuid}.mp3"
+        s3_client.copy_object(Bucket=bucket_name, Key=object_name,
+                              CopySource={"Bucket": bucket_name, "Key": source})
+        s3_client.delete_object(Bucket=bucket_name, Key=source)
+        print(f"Audio for {uuid} written to {bucket_name}/{object_name}")
+    elif task["TaskStatus"] == "failed":
+        print(f"Synthesis task for {uuid} failed: {task.get('TaskStatusReason')}")
+    return task["TaskStatus"]
+
+
+def synthesize_tasks(texts, poll_interval=TASK_POLL_INTERVAL, workers=WORKERS, rps=POLLY_RPS):
+    # Start a Polly synthesis task for every (uuid, text) and poll them together until
+    # each one has written its mp3 to text_audios/ in the bucket
+    s3_client = get_client('s3')
+    polly_client = get_client('polly', region_name='us-east-1')
+    limiter = RateLimiter(rps)
+
+    # Texts whose audio is already in the bucket are skipped
+    done = {obj['Key'].split("/")[-1] for obj in list_objects(s3_client, text_audios + "/")}
+    tasks = load_tasks_state()
+
+    for uuid, input_text in texts:
+        if uuid + ".mp3" in done or uuid in tasks:
+            continue
+        try:
+            tasks[uuid] = start_task(polly_client, limiter, uuid, input_text)
+        except Exception as e:
+            print(f"Starting the synthesis task for {uuid} failed: {e!r}")
+            continue
+        save_tasks_state(tasks)
+
+    def check(uuid):
+        try:
+            return uuid, check_task(polly_client, s3_client, uuid, tasks[uuid])
+        except Exception as e:
+            print(f"Synthesis task of {uuid} could not be checked: {e!r}")
+            return uuid, None
+
+    # Throttling or a network error only fails one check, the task is checked again on the
+    # next poll. A task that keeps failing stays in the state file for the next run
+    running = list(tasks)
+    errors = dict.fromkeys(running, 0)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while running:
+            for uuid, status in executor.map(check, list(running)):
+                if status is None:
+                    errors[uuid] += 1
+                    if errors[uuid] >= TASK_CHECK_RETRIES:
+                        running.remove(uuid)
+                    continue
+                errors[uuid] = 0
+                if status in ("completed", "failed"):
+                    del tasks[uuid]
+                    running.remove(uuid)
+            save_tasks_state(tasks)
+            if running:
+                print(f"{len(running)} synthesis tasks running, checking again in {poll_interval}s")
+                time.sleep(poll_interval)
+
+    if tasks:
+        print(f"{len(tasks)} synthesis tasks left in {tasks_state_file} for the next run")
+    elif os.path.exists(tasks_state_file):
+        os.remove(tasks_state_file)
+
+
+def synthesis(concurrency=POLLY_CONCURRENCY, rps=POLLY_RPS, pack=False, pack_max_chars=PACK_MAX_CHARS,
+              poll_interval=TASK_POLL_INTERVAL):
     print("synthesis")
     makedirs()
 
+    # Leftovers of a run that stopped mid-write
+    for file_name in os.listdir(text_audios):
+        if file_name.endswith(".tmp"):
+            os.remove(os.path.join(text_audios, file_name))
+
     # Get the list of text file
     text_files = os.listdir(text_paragraphs)
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
-
+    # Create a Polly client, shared by every thread
+    polly_client = get_client('polly', region_name='us-east-1')
+    limiter = RateLimiter(rps)
+    long_texts = []
+
+    def texts():
+        for text_file in text_files:
+            uuid = text_file.replace(".txt", "")
+            file_path = os.path.join(text_paragraphs, text_file)
+            audio_file = os.path.join(text_audios, uuid + ".mp3")
+
+            if os.path.exists(audio_file):
+                continue
+
+            with open(file_path) as f:
+                input_text = f.read()
+
+            if len(input_text) > SYNC_MAX_CHARS:
+                long_texts.append((uuid, input_text))
+                continue
+
+            yield uuid, input_text, audio_file
+
+    start_time = time.time()
+    count = 0
+    characters = 0
+    requests = 0
+    failed = []
+
+    def finished(future, uuids):
+        nonlocal count, characters, requests
+        try:
+            sent, made = future.result()
+            characters += sent
+            requests += made
+            count += len(uuids)
+        except Exception as e:
+            print(f"Synthesis of {', '.join(uuids)} failed: {e}")
+            failed.extend(uuids)
+
+    # Bound the queued texts so files are only read as fast as the pool drains them
+    pending = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for items in pack_texts(texts(), pack_max_chars) if pack else ([item] for item in texts()):
+            if len(pending) >= concurrency * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future, pending.pop(future))
+            if pack:
+                future = executor.submit(synthesize_pack, polly_client, limiter, items)
+            else:
+                future = executor.submit(synthesize_text, polly_client, limiter, *items[0])
+            pending[future] = [uuid for uuid, _, _ in items]
+        for future in as_completed(pending):
+            finished(future, pending[future])
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"Synthesized {count} texts ({characters} characters) with {requests} Polly requests in {elapsed:.2f}s: "
+          f"{count / elapsed:.1f} texts/s, {limiter.throttled} throttled")
+    if failed:
+        print(f"Failed {len(failed)} texts: {', '.join(sorted(failed))}")
+
+    if long_texts:
+        # Their audio goes straight to the bucket, upload only sends the local files
+        synthesize_tasks(long_texts, poll_interval, rps=rps)
+
+    if audio_cache is not None:
+        audio_cache.report()
+        audio_cache.evict()
+
+
+def stream(part_size=PART_SIZE, max_concurrency=MAX_CONCURRENCY, poll_interval=TASK_POLL_INTERVAL):
+    # Read paragraphs straight from S3 and pipe Polly audio straight back, no local folders
+    print("stream")
+
+    s3_client = get_client('s3')
+    polly_client = get_client('polly', region_name='us-east-1')
+    config = transfer_config(part_size, max_concurrency)
+
+    # Paragraphs that already have audio in the bucket are skipped
+    done = {obj['Key'].split("/")[-1] for obj in list_objects(s3_client, text_audios + "/")}
+    long_texts = []
+
+    for obj in list_objects(s3_client, text_paragraphs + "/"):
+        if obj['Key'].endswith("/"):
+            continue
+        uuid = obj['Key'].split("/")[-1].replace(".txt", "")
+        if uuid + ".mp3" in done:
+            continue
 
-    for text_file in text_files:
-        uuid = text_file.replace(".txt", "")
-        file_path = os.path.join(text_paragraphs, text_file)
-        audio_file = os.path.join(text_audios, uuid + ".mp3")
+        response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
+        input_text = response['Body'].read().decode("utf-8")
 
-        if os.path.exists(audio_file):
+        if len(input_text) > SYNC_MAX_CHARS:
+            long_texts.append((uuid, input_text))
             continue
 
-        with open(file_path) as f:
-            input_text = f.read()
-
         # Call the Polly API to synthesize speech
         response = polly_client.synthesize_speech(
             Text=input_text,
-            OutputFormat="mp3", 
-            VoiceId="Joanna",    # Select the voice you'd like to use (e.g., "Joanna", "Matthew", etc.)
+            OutputFormat=OUTPUT_FORMAT,
+            VoiceId=VOICE_ID,
         )
 
-        # Save the audio file
-        with open(audio_file, "wb") as out:
-            # Write the response to the output file.
-            out.write(response["AudioStream"].read())
+        # upload_fileobj switches to a multipart upload once the stream passes the part size
+        object_name = f'{text_audios}/{uuid}.mp3'
+        s3_client.upload_fileobj(response["AudioStream"], bucket_name, object_name, Config=config)
+        print(f"Audio for {obj['Key']} uploaded to {bucket_name}/{object_name}")
+
+    if long_texts:
+        synthesize_tasks(long_texts, poll_interval)
 
 
-def upload():
+def upload(workers=WORKERS, part_size=PART_SIZE, max_concurrency=MAX_CONCURRENCY):
     print("upload")
     makedirs()
 
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
-
-    folder_name = text_audios
-    # Get the list of files
-    audio_files = os.listdir(text_audios)
+    s3_client = get_client('s3')
 
-    for audio_file in audio_files:
-        file_path = os.path.join(text_audios, audio_file)
-        object_name = f'{folder_name}/{audio_file}'
-        
-        # Upload the file
-        s3_client.upload_file(file_path, bucket_name, object_name)
-        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+    upload_files(s3_client, text_audios, text_audios, workers, part_size, max_concurrency)
 
 # Generate the inputs arguments parser
 parser = argparse.ArgumentParser(description="Command description.")
@@ -136,12 +863,20 @@ parser = argparse.ArgumentParser(description="Command description.")
 def main(args=None):
     print("Args:", args)
 
+    global pool_connections, audio_cache
+    pool_connections = args.workers * args.max_concurrency
+    audio_cache = make_cache(args.cache, args.cache_max_mb)
+
+    if args.stream:
+        stream(part_size=args.part_size * 1024 * 1024, max_concurrency=args.max_concurrency,
+               poll_interval=args.poll_interval)
     if args.download:
-        download()
+        download(workers=args.workers)
     if args.synthesis:
-        synthesis()
+        synthesis(concurrency=args.concurrency, rps=args.rps, pack=args.pack, pack_max_chars=args.pack_max_chars,
+                  poll_interval=args.poll_interval)
     if args.upload:
-        upload()
+        upload(workers=args.workers, part_size=args.part_size * 1024 * 1024, max_concurrency=args.max_concurrency)
 
 
 if __name__ == "__main__":
@@ -164,6 +899,83 @@ if __name__ == "__main__":
         "-u", "--upload", action="store_true", help="Upload audio file to AWS"
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of concurrent S3 transfers",
+    )
+
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=PART_SIZE // (1024 * 1024),
+        help="Multipart upload part size in MB",
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Number of concurrent part uploads per file",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=POLLY_CONCURRENCY,
+        help="Most concurrent Polly requests",
+    )
+
+    parser.add_argument(
+        "--rps",
+        type=float,
+        default=POLLY_RPS,
+        help="Most Polly requests started per second, 0 for no limit",
+    )
+
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Voice several short texts per Polly request and split the audio with speech marks",
+    )
+
+    parser.add_argument(
+        "--pack-max-chars",
+        type=int,
+        default=PACK_MAX_CHARS,
+        help="Most characters of text in one packed request",
+    )
+
+    parser.add_argument(
+        "--poll-interval",
+        type=int,
+        default=TASK_POLL_INTERVAL,
+        help="Seconds between status checks of Polly synthesis tasks for long texts",
+    )
+
+    parser.add_argument(
+        "--cache",
+        choices=["local", "s3", "off"],
+        default="local",
+        help="Where to cache synthesized audio, s3 adds the bucket behind the local cache",
+    )
+
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=CACHE_MAX_MB,
+        help="Size limit of the local audio cache in MB",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream inputs from S3 through the stage and back to S3 without local files",
+    )
+
     args = parser.parse_args()
 
     main(args)
@@ -2,135 +2,697 @@
 Module that contains the command line app.
 """
 import os
+import hashlib
+import shutil
+import random
+import audioop
+import queue
+from collections import deque
+import json
 import io
 import argparse
-import shutil
-import ffmpeg
 from tempfile import TemporaryDirectory
-import boto3
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import csv
 import time
-import speech_recognition as sr
-from pydub import AudioSegment
+import threading
+from functools import lru_cache
 
 bucket_name = 'megapipeline-s3bucket'
 input_audios = "input_audios"
 text_prompts = "text_prompts"
+cache_folder = ".transcript_cache"
+
+# Number of concurrent S3 transfers
+WORKERS = 8
+
+# Multipart upload settings, the 8 MB part size matches the boto3 default so
+# ETags of objects uploaded by earlier runs still compare equal
+PART_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 10
+
+# Audio is decoded to the format the recognizer sends anyway: 16 kHz mono 16-bit PCM
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# Decoding is CPU bound and runs in one ffmpeg process per file, recognition waits
+# on the network and runs in threads shared by all files
+DECODE_PROCESSES = os.cpu_count() or 1
+RECOGNIZE_THREADS = 8
+
+# Recordings are cut at pauses into segments of at most SEGMENT_MAX_SECONDS, and a
+# file keeps at most RECOGNIZE_THREADS segments in memory, so memory use and request
+# size don't grow with the length of the recording
+SEGMENT_MIN_SECONDS = 5
+SEGMENT_MAX_SECONDS = 30
+FRAME_SECONDS = 0.03
+SILENCE_SECONDS = 0.3
+SILENCE_RMS = 300
+SEGMENT_RETRIES = 3
+
+# Speech recognition backends: "google" sends every segment to the Google Web Speech
+# API, "whisper" runs a local Whisper model on the CPU and needs no network
+RECOGNIZERS = ["google", "whisper"]
+RECOGNIZER = "google"
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "openai/whisper-tiny.en")
+BATCH_SIZE = 8
+BATCH_WAIT = 0.2
+
+# Transcripts of audio seen before are reused, the cache keeps the most recently
+# used entries up to CACHE_MAX_MB
+CACHE_MAX_MB = 64
 
 def makedirs():
     os.makedirs(input_audios, exist_ok=True)
     os.makedirs(text_prompts, exist_ok=True)
 
-# Path to your CSV file
-csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
+@lru_cache(maxsize=None)
+def get_credentials():
+    # Read on first use so --help and steps that never call AWS don't need the file
+    # Path to your CSV file
+    csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
+
+    # Read the CSV file
+    with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        credentials = next(reader)  # Assuming the CSV has only one row of credentials
+
+    # Extract the access key and secret key
+    return credentials['Access key ID'], credentials['Secret access key']
+
+
+# Size of the HTTP connection pool of every client, set from the CLI in main()
+pool_connections = WORKERS * MAX_CONCURRENCY
+
+# One session and one client per (service, region), created on first use and
+# shared by every step so a download+process+upload run keeps its connections warm
+boto3_session = None
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service, region_name=None):
+    global boto3_session
+    import boto3
+    from botocore.config import Config
+
+    with clients_lock:
+        if boto3_session is None:
+            access_key, secret_key = get_credentials()
+            # Create a boto3 session
+            boto3_session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+        if (service, region_name) not in clients:
+            clients[(service, region_name)] = boto3_session.client(
+                service,
+                region_name=region_name,
+                config=Config(max_pool_connections=pool_connections),
+            )
+        return clients[(service, region_name)]
+
+
+def list_objects(s3_client, prefix):
+    # Page through the prefix, list_objects_v2 returns at most 1000 keys per call
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def report_throughput(action, count, total_bytes, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    megabytes = total_bytes / (1024 * 1024)
+    print(f"{action} {count} files ({megabytes:.2f} MB) in {elapsed:.2f}s: "
+          f"{count / elapsed:.1f} objects/s, {megabytes / elapsed:.2f} MB/s")
+
+
+def download_objects(s3_client, objects, local_folder, workers, on_downloaded=None):
+    # Bound the number of queued downloads so the listing generator is only
+    # consumed as fast as the pool drains it
+    def download_object(obj):
+        local_file_path = os.path.join(local_folder, obj['Key'].split("/")[-1])
+        s3_client.download_file(bucket_name, obj['Key'], local_file_path)
+        print(f"File {obj['Key']} downloaded to {local_file_path}")
+        return obj
+
+    start_time = time.time()
+    count = 0
+    total_bytes = 0
+
+    def finished(future):
+        nonlocal count, total_bytes
+        obj = future.result()
+        count += 1
+        total_bytes += obj['Size']
+        if on_downloaded is not None:
+            on_downloaded(obj)
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for obj in objects:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future)
+            pending.add(executor.submit(download_object, obj))
+        for future in as_completed(pending):
+            finished(future)
+
+    report_throughput("Downloaded", count, total_bytes, time.time() - start_time)
+
+
+def manifest_path(local_folder):
+    # Kept next to (not inside) the folder so os.listdir() only sees data files
+    return f".{local_folder}.manifest.json"
+
+
+def load_manifest(local_folder):
+    path = manifest_path(local_folder)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(local_folder, manifest):
+    path = manifest_path(local_folder)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def sync_objects(s3_client, objects, local_folder, workers):
+    # Mirror the listed objects into local_folder, fetching only keys whose
+    # ETag, size or last-modified changed since the previous sync
+    manifest = load_manifest(local_folder)
+    synced = {}
+    remote_files = set()
+
+    def entry(obj):
+        return {
+            'key': obj['Key'],
+            'etag': obj['ETag'],
+            'size': obj['Size'],
+            'last_modified': obj['LastModified'].isoformat(),
+        }
+
+    def changed_objects():
+        for obj in objects:
+            file_name = obj['Key'].split("/")[-1]
+            remote_files.add(file_name)
+            if manifest.get(file_name) == entry(obj) and os.path.exists(os.path.join(local_folder, file_name)):
+                synced[file_name] = manifest[file_name]
+            else:
+                yield obj
+
+    def on_downloaded(obj):
+        synced[obj['Key'].split("/")[-1]] = entry(obj)
+
+    try:
+        download_objects(s3_client, changed_objects(), local_folder, workers, on_downloaded)
+    finally:
+        save_manifest(local_folder, synced)
+
+    # Remove local files whose keys no longer exist in the bucket
+    for file_name in os.listdir(local_folder):
+        if file_name not in remote_files:
+            os.remove(os.path.join(local_folder, file_name))
+            print(f"File {file_name} removed from {local_folder}")
+
+
+def local_etag(file_path, part_size):
+    # S3 reports the MD5 of the body as the ETag of a single-part upload, and the
+    # MD5 of the concatenated part digests plus "-<parts>" for a multipart one
+    part_digests = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+
+    if os.path.getsize(file_path) < part_size:
+        return part_digests[0].hex() if part_digests else hashlib.md5(b'').hexdigest()
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f"-{len(part_digests)}"
+
+
+def transfer_config(part_size, max_concurrency):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency,
+    )
+
 
-# Read the CSV file
-with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
-    reader = csv.DictReader(file)
-    credentials = next(reader)  # Assuming the CSV has only one row of credentials
+def upload_files(s3_client, local_folder, s3_folder, workers, part_size, max_concurrency):
+    config = transfer_config(part_size, max_concurrency)
 
-# Extract the access key and secret key
-access_key = credentials['Access key ID']
-secret_key = credentials['Secret access key']
+    # One listing pass gives the ETag of every object already in the bucket
+    remote_etags = {obj['Key']: obj['ETag'].strip('"') for obj in list_objects(s3_client, s3_folder + "/")}
 
-def download():
+    def upload_file(file_name):
+        file_path = os.path.join(local_folder, file_name)
+        object_name = f'{s3_folder}/{file_name}'  # The name of the file in the bucket, including the folder
+
+        if remote_etags.get(object_name) == local_etag(file_path, part_size):
+            return None
+
+        # Upload the file
+        s3_client.upload_file(file_path, bucket_name, object_name, Config=config)
+        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+        return os.path.getsize(file_path)
+
+    start_time = time.time()
+    count = 0
+    skipped = 0
+    total_bytes = 0
+    # Temporary files of a run that stopped mid-write are not outputs
+    file_names = [file_name for file_name in os.listdir(local_folder) if not file_name.endswith(".tmp")]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size in executor.map(upload_file, file_names):
+            if size is None:
+                skipped += 1
+            else:
+                count += 1
+                total_bytes += size
+
+    report_throughput("Uploaded", count, total_bytes, time.time() - start_time)
+    print(f"Skipped {skipped} unchanged files")
+
+
+def download(workers=WORKERS):
     print("download")
 
-    # Clear
-    shutil.rmtree(input_audios, ignore_errors=True, onerror=None)
     makedirs()
 
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
+    s3_client = get_client('s3')
 
     # List files in the specified folder
     folder_name = 'input_audios/'  # Replace with your folder name in S3
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=folder_name)
+    blobs = (obj for obj in list_objects(s3_client, folder_name)
+             if not obj['Key'].endswith("/"))
+
+    sync_objects(s3_client, blobs, input_audios, workers)
+
+def decode_pcm(source):
+    # Pipe the mp3 through ffmpeg and yield 16 kHz mono PCM as it is decoded, no wav file
+    # on disk. source is a local path, which ffmpeg reads itself, or a file object
+    import ffmpeg
+
+    from_file = not isinstance(source, str)
+    process = (
+        ffmpeg.input("pipe:0" if from_file else source)
+        .output("pipe:1", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .global_args("-loglevel", "error")
+        .run_async(pipe_stdin=from_file, pipe_stdout=True, pipe_stderr=True)
+    )
 
-    blobs = []
-    if 'Contents' in response:
-        for obj in response['Contents']:
-            blobs.append(obj['Key'])
+    if from_file:
+        def feed():
+            try:
+                shutil.copyfileobj(source, process.stdin)
+            except (BrokenPipeError, ValueError):
+                pass
+            finally:
+                process.stdin.close()
+
+        threading.Thread(target=feed, daemon=True).start()
+
+    frame_bytes = int(SAMPLE_RATE * FRAME_SECONDS) * SAMPLE_WIDTH
+    try:
+        while True:
+            frame = process.stdout.read(frame_bytes)
+            if not frame:
+                break
+            yield frame
+        if process.wait() != 0:
+            raise ffmpeg.Error("ffmpeg", None, process.stderr.read())
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def split_silences(frames):
+    # Group PCM frames into segments that end in a pause once they are long enough,
+    # or at the last pause (else hard) once they reach the maximum length
+    min_bytes = int(SAMPLE_RATE * SEGMENT_MIN_SECONDS) * SAMPLE_WIDTH
+    max_bytes = int(SAMPLE_RATE * SEGMENT_MAX_SECONDS) * SAMPLE_WIDTH
+    silence_frames = max(int(SILENCE_SECONDS / FRAME_SECONDS), 1)
+
+    segment = bytearray()
+    quiet = 0
+    last_pause = 0
+    for frame in frames:
+        segment += frame
+        if audioop.rms(frame, SAMPLE_WIDTH) < SILENCE_RMS:
+            quiet += 1
+            last_pause = len(segment)
+        else:
+            quiet = 0
+
+        if len(segment) >= min_bytes and quiet >= silence_frames:
+            yield bytes(segment)
+            segment = bytearray()
+            quiet = 0
+            last_pause = 0
+        elif len(segment) >= max_bytes:
+            cut = last_pause if last_pause >= min_bytes else len(segment)
+            yield bytes(segment[:cut])
+            segment = segment[cut:]
+            quiet = 0
+            last_pause = 0
+
+    if segment:
+        yield bytes(segment)
+
+
+def recognize(pcm, retries=SEGMENT_RETRIES):
+    import speech_recognition as sr
+
+    r = sr.Recognizer()
+    audio = sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH)
+    for attempt in range(retries + 1):
+        try:
+            return r.recognize_google(audio)
+        except sr.UnknownValueError:
+            # No speech in this segment
+            return ""
+        except sr.RequestError as e:
+            if attempt == retries:
+                raise
+            delay = 2 ** attempt + random.random()
+            print(f"Recognition failed ({e}), retrying segment in {delay:.1f}s")
+            time.sleep(delay)
+
+
+class GoogleRecognizer:
+    # One Web Speech API request per segment on a thread pool
+    def __init__(self, threads):
+        self.name = "google"
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads
+
+    def submit(self, pcm):
+        return self.executor.submit(recognize, pcm)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+@lru_cache(maxsize=None)
+def load_whisper(model_name):
+    # Loaded once per process and kept warm for every batch after the first
+    from transformers import WhisperProcessor, WhisperForConditionalGeneration
+
+    print(f"Loading {model_name}")
+    processor = WhisperProcessor.from_pretrained(model_name)
+    model = WhisperForConditionalGeneration.from_pretrained(model_name).eval()
+    return processor, model
+
+
+class WhisperRecognizer:
+    # Segments submitted from any thread are queued and transcribed up to batch_size
+    # at a time in one forward pass on a single inference thread
+    def __init__(self, batch_size, model_name=WHISPER_MODEL):
+        self.name = f"whisper:{model_name}"
+        self.batch_size = batch_size
+        self.model_name = model_name
+        # Keep the next batch queued while the current one runs
+        self.max_pending = batch_size * 2
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, pcm):
+        future = Future()
+        self.queue.put((pcm, future))
+        return future
+
+    def shutdown(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def next_batch(self):
+        # Block for the first segment, then wait up to BATCH_WAIT for the batch to fill
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + BATCH_WAIT
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish this batch, then stop
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            try:
+                texts = self.recognize_batch([pcm for pcm, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), text in zip(batch, texts):
+                    future.set_result(text)
+
+    def recognize_batch(self, segments):
+        import numpy as np
+        import torch
+
+        processor, model = load_whisper(self.model_name)
+
+        # Whisper makes up text for silence, so segments with no sound aren't sent
+        texts = [""] * len(segments)
+        voiced = [i for i, pcm in enumerate(segments) if audioop.rms(pcm, SAMPLE_WIDTH) >= SILENCE_RMS]
+        if voiced:
+            audio = [np.frombuffer(segments[i], dtype=np.int16).astype(np.float32) / 32768 for i in voiced]
+            features = processor(audio, sampling_rate=SAMPLE_RATE, return_tensors="pt").input_features
+            with torch.inference_mode():
+                ids = model.generate(features)
+            for i, text in zip(voiced, processor.batch_decode(ids, skip_special_tokens=True)):
+                texts[i] = text.strip()
+        return texts
+
+
+def make_recognizer(backend=RECOGNIZER, threads=RECOGNIZE_THREADS, batch_size=BATCH_SIZE):
+    if backend == "whisper":
+        return WhisperRecognizer(batch_size)
+    return GoogleRecognizer(threads)
+
+
+def transcribe_recording(source, recognizer):
+    # Recognize the segments of one recording concurrently and join them in order,
+    # decoding stops while max_pending segments are waiting for a result
+    pending = deque()
+    texts = []
+    for segment in split_silences(decode_pcm(source)):
+        pending.append(recognizer.submit(segment))
+        if len(pending) >= recognizer.max_pending:
+            texts.append(pending.popleft().result())
+    while pending:
+        texts.append(pending.popleft().result())
+    return " ".join(text for text in texts if text)
+
+
+class TranscriptCache:
+    # Transcripts keyed by a hash of the audio, one file per key. The file mtime
+    # doubles as the last-used time for LRU eviction
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = {"mp3": 0, "pcm": 0}
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.folder, key + ".txt")
+        try:
+            with open(path) as f:
+                text = f.read()
+            os.utime(path)
+            return text
+        except OSError:
+            return None
+
+    def put(self, key, text):
+        # Threads storing the same transcript at once each write their own temporary file
+        path = os.path.join(self.folder, key + ".txt")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def count(self, kind):
+        with self.lock:
+            if kind is None:
+                self.misses += 1
+            else:
+                self.hits[kind] += 1
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.folder):
+            stat = os.stat(os.path.join(self.folder, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        # Drop least recently used entries until the cache fits
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.folder, file_name))
+            total_bytes -= size
+
+    def report(self):
+        total = max(sum(self.hits.values()) + self.misses, 1)
+        print(f"Transcript cache: {self.hits['mp3']} mp3 hits, {self.hits['pcm']} pcm hits, {self.misses} misses "
+              f"({100 * sum(self.hits.values()) / total:.0f}% hit rate)")
+
+
+# Set from the CLI in main(), None disables caching
+transcript_cache = None
+
+
+def make_cache(backend, max_mb):
+    if backend == "local":
+        return TranscriptCache(cache_folder, max_mb * 1024 * 1024)
+    return None
+
+
+def audio_key(recognizer, blocks):
+    # Different backends transcribe the same audio differently, so the backend is part of the key
+    digest = hashlib.sha256(recognizer.name.encode("utf-8") + b"\0")
+    for block in blocks:
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def transcribe_cached(audio_path, recognizer):
+    # Hash the mp3 bytes first, which is cheap, then the decoded PCM, which also matches
+    # the same recording with different tags or container, before running recognition.
+    # Decoding a miss twice costs far less than recognizing a duplicate
+    if transcript_cache is None:
+        return transcribe_recording(audio_path, recognizer)
+
+    with open(audio_path, "rb") as f:
+        mp3_key = audio_key(recognizer, iter(lambda: f.read(1024 * 1024), b""))
+    text = transcript_cache.get(mp3_key)
+    if text is not None:
+        transcript_cache.count("mp3")
+        return text
+
+    pcm_key = audio_key(recognizer, decode_pcm(audio_path))
+    text = transcript_cache.get(pcm_key)
+    if text is not None:
+        transcript_cache.count("pcm")
     else:
-        print(f"No files found in folder {folder_name}")
-    
-    for blob in blobs:
-        if not blob.endswith("/"):
-            # Download the file
-            local_file_path = os.path.join(folder_name, blob.split("/")[-1])
-            s3_client.download_file(bucket_name, blob, local_file_path)
-            print(f"File {blob} downloaded to {local_file_path}")
-
-def transcribe():
+        transcript_cache.count(None)
+        text = transcribe_recording(audio_path, recognizer)
+        transcript_cache.put(pcm_key, text)
+    transcript_cache.put(mp3_key, text)
+    return text
+
+
+def write_text(text_file, text):
+    # Write to a temporary file and rename so a killed run never leaves a partial transcript
+    with open(text_file + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(text_file + ".tmp", text_file)
+
+
+def transcribe(processes=DECODE_PROCESSES, threads=RECOGNIZE_THREADS, backend=RECOGNIZER, batch_size=BATCH_SIZE):
     print("transcribe")
     makedirs()
 
-    # Get the list of audio files
-    audio_files = os.listdir(input_audios)
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    transcribe_client = session.client('transcribe', region_name='us-east-1')
-
-    for audio_path in audio_files:
-        uuid = audio_path.replace(".mp3", "")
-        audio_path = os.path.join(input_audios, audio_path)
-        text_file = os.path.join(text_prompts, uuid + ".txt")
+    # Audio files that don't have a transcript yet
+    pending = []
+    for audio_file in os.listdir(input_audios):
+        uuid = audio_file.replace(".mp3", "")
+        if not os.path.exists(os.path.join(text_prompts, uuid + ".txt")):
+            pending.append(uuid)
 
-        if os.path.exists(text_file):
-            continue
+    recognizer = make_recognizer(backend, threads, batch_size)
 
+    def transcribe_file(uuid):
+        audio_path = os.path.join(input_audios, uuid + ".mp3")
         print("Transcribing:", audio_path)
 
-        r = sr.Recognizer()
+        text = transcribe_cached(audio_path, recognizer)
+        print(text)
 
-        # convert mp3 file to wav                                                       
-        audio_file = AudioSegment.from_mp3(audio_path)
-        audio_file.export("transcript.wav", format="wav")
+        # Save the transcription
+        write_text(os.path.join(text_prompts, uuid + ".txt"), text)
+
+    start_time = time.time()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(transcribe_file, uuid): uuid for uuid in pending}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed to transcribe {futures[future]}: {e!r}")
+    elapsed = max(time.time() - start_time, 1e-6)
+    recognizer.shutdown()
+
+    done = len(pending) - failed
+    print(f"Transcribed {done} files in {elapsed:.2f}s: {done / elapsed:.2f} files/s, {failed} failed")
+
+    if transcript_cache is not None:
+        transcript_cache.report()
+        transcript_cache.evict()
+
+def stream(threads=RECOGNIZE_THREADS, backend=RECOGNIZER, batch_size=BATCH_SIZE):
+    # Read audio straight from S3 and write transcripts straight back, no local folders
+    print("stream")
+
+    s3_client = get_client('s3')
+    recognizer = make_recognizer(backend, threads, batch_size)
+
+    # Audio files that already have a transcript in the bucket are skipped
+    done = {obj['Key'].split("/")[-1] for obj in list_objects(s3_client, text_prompts + "/")}
+
+    for obj in list_objects(s3_client, input_audios + "/"):
+        if obj['Key'].endswith("/"):
+            continue
+        uuid = obj['Key'].split("/")[-1].replace(".mp3", "")
+        if uuid + ".txt" in done:
+            continue
 
-        # Use sr.AudioFile for the context manager
-        with sr.AudioFile("transcript.wav") as source:
-            audio = r.record(source)
+        print("Transcribing:", obj['Key'])
 
-        text = r.recognize_google(audio)
+        response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
+        text = transcribe_recording(response['Body'], recognizer)
         print(text)
 
-        uuid = audio_path.replace(".mp3", "").split("/")[-1]
-        # audio_path = os.path.join(input_audios, audio_path.split("/")[-1])
-        text_file = os.path.join(text_prompts, uuid + ".txt")
-        # Save the transcription
-        with open(text_file, "w") as f:
-            f.write(text)
+        object_name = f'{text_prompts}/{uuid}.txt'
+        s3_client.put_object(Bucket=bucket_name, Key=object_name, Body=text.encode("utf-8"))
+        print(f"Transcript for {obj['Key']} uploaded to {bucket_name}/{object_name}")
 
-def upload():
-    print("upload")
-    makedirs()
+    recognizer.shutdown()
 
-    # Get the list of text file
-    text_files = os.listdir(text_prompts)
-    print(text_files)
 
-    # Create a boto3 session
-    session = boto3.Session(
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    s3_client = session.client('s3')
+def upload(workers=WORKERS, part_size=PART_SIZE, max_concurrency=MAX_CONCURRENCY):
+    print("upload")
+    makedirs()
 
-    folder_name = text_prompts
-    for text_file in text_files:
-        file_path = os.path.join(text_prompts, text_file)
-        object_name = f'{folder_name}/{text_file}'  # The name of the file in the bucket, including the folder
+    s3_client = get_client('s3')
 
-        # Upload the file
-        s3_client.upload_file(file_path, bucket_name, object_name)
-        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+    upload_files(s3_client, text_prompts, text_prompts, workers, part_size, max_concurrency)
 
 # Generate the inputs arguments parser
 parser = argparse.ArgumentParser(description="Command description.")
@@ -138,12 +700,19 @@ parser = argparse.ArgumentParser(description="Command description.")
 def main(args=None):
     print("Args:", args)
 
+    global pool_connections, transcript_cache
+    pool_connections = args.workers * args.max_concurrency
+    transcript_cache = make_cache(args.cache, args.cache_max_mb)
+
+    if args.stream:
+        stream(threads=args.recognize_threads, backend=args.recognizer, batch_size=args.batch_size)
     if args.download:
-        download()
+        download(workers=args.workers)
     if args.transcribe:
-        transcribe()
+        transcribe(processes=args.decode_processes, threads=args.recognize_threads,
+                   backend=args.recognizer, batch_size=args.batch_size)
     if args.upload:
-        upload()
+        upload(workers=args.workers, part_size=args.part_size * 1024 * 1024, max_concurrency=args.max_concurrency)
 
 if __name__ == "__main__":
     # Generate the inputs arguments parser
@@ -168,6 +737,77 @@ if __name__ == "__main__":
         help="Upload transcribed text to GCS bucket",
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of concurrent S3 transfers",
+    )
+
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=PART_SIZE // (1024 * 1024),
+        help="Multipart upload part size in MB",
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Number of concurrent part uploads per file",
+    )
+
+    parser.add_argument(
+        "--decode-processes",
+        type=int,
+        default=DECODE_PROCESSES,
+        help="Number of audio files decoded at once, each by its own ffmpeg process",
+    )
+
+    parser.add_argument(
+        "--recognize-threads",
+        type=int,
+        default=RECOGNIZE_THREADS,
+        help="Number of concurrent speech recognition requests",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--recognizer",
+        choices=RECOGNIZERS,
+        default=RECOGNIZER,
+        help="Speech recognition backend, whisper runs locally on the CPU",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="Audio segments per forward pass of the local model",
+    )
+
+    parser.add_argument(
+        "--cache",
+        choices=["local", "off"],
+        default="local",
+        help="Reuse transcripts of audio that was transcribed before",
+    )
+
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=CACHE_MAX_MB,
+        help="Size limit of the transcript cache in MB",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream inputs from S3 through the stage and back to S3 without local files",
+    )
+
     args = parser.parse_args()
 
     main(args)
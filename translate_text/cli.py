@@ -0,0 +1,756 @@
+"""
+Module that contains the command line app.
+"""
+import os
+import hashlib
+import json
+import argparse
+import time
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+import csv
+
+bucket_name = 'megapipeline-s3bucket'
+text_paragraphs = "text_paragraphs"
+text_translated = "text_translated"
+cache_folder = ".translation_cache"
+
+# Number of concurrent S3 transfers
+WORKERS = 8
+
+# Multipart upload settings, the 8 MB part size matches the boto3 default so
+# ETags of objects uploaded by earlier runs still compare equal
+PART_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 10
+
+# Paragraphs are translated from SOURCE_LANGUAGE into TARGET_LANGUAGE for synthesis_audio
+SOURCE_LANGUAGE = "en"
+TARGET_LANGUAGE = "fr"
+
+# Translation backends, aws is Amazon Translate, marian a local MarianMT model and
+# pseudo an offline stand-in that only accents the text, for testing the stage
+TRANSLATORS = ["aws", "marian", "pseudo"]
+TRANSLATOR = "aws"
+# Defaults to the Helsinki-NLP opus-mt model of the language pair
+MARIAN_MODEL = os.environ.get("MARIAN_MODEL")
+
+# Sentences are packed into requests of at most BATCH_CHARS characters, translate_text
+# takes up to 10000 bytes. CONCURRENCY requests run at once for remote backends
+BATCH_CHARS = 5000
+CONCURRENCY = 4
+# Sentences per forward pass of the local model
+BATCH_SIZE = 16
+# The local model reads at most 512 tokens of a sentence, longer ones are cut between
+# words into pieces of at most MARIAN_MAX_CHARS characters before translation
+MARIAN_MAX_CHARS = 1000
+
+# Paragraphs read and written per round, bounds what is held in memory
+GROUP_SIZE = 200
+
+# Translated sentences are reused, the cache keeps the most recently used up to CACHE_MAX_MB
+CACHE_MAX_MB = 64
+
+# A sentence ends at terminal punctuation, optionally followed by a closing quote or
+# bracket, or at a line break. Separators are kept to rebuild the paragraph
+sentence_break = re.compile(r'((?<=[.!?])\s+|(?<=[.!?]["\')\]])\s+|\s*\n\s*)')
+word_break = re.compile(r'\s+')
+
+def makedirs():
+    os.makedirs(text_paragraphs, exist_ok=True)
+    os.makedirs(text_translated, exist_ok=True)
+    
+    
+@lru_cache(maxsize=None)
+def get_credentials():
+    # Read on first use so --help and steps that never call AWS don't need the file
+    # Path to your CSV file
+    csv_file_path = os.getenv('AWS_APPLICATION_CREDENTIALS')
+
+    # Read the CSV file
+    with open(csv_file_path, mode='r',  encoding='utf-8-sig') as file:
+        reader = csv.DictReader(file)
+        credentials = next(reader)  # Assuming the CSV has only one row of credentials
+
+    # Extract the access key and secret key
+    return credentials['Access key ID'], credentials['Secret access key']
+
+
+# Size of the HTTP connection pool of every client, set from the CLI in main()
+pool_connections = WORKERS * MAX_CONCURRENCY
+
+# One session and one client per (service, region), created on first use and
+# shared by every step so a download+process+upload run keeps its connections warm
+boto3_session = None
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service, region_name=None):
+    global boto3_session
+    import boto3
+    from botocore.config import Config
+
+    with clients_lock:
+        if boto3_session is None:
+            access_key, secret_key = get_credentials()
+            # Create a boto3 session
+            boto3_session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+        if (service, region_name) not in clients:
+            clients[(service, region_name)] = boto3_session.client(
+                service,
+                region_name=region_name,
+                config=Config(max_pool_connections=pool_connections),
+            )
+        return clients[(service, region_name)]
+
+
+def list_objects(s3_client, prefix):
+    # Page through the prefix, list_objects_v2 returns at most 1000 keys per call
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def report_throughput(action, count, total_bytes, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    megabytes = total_bytes / (1024 * 1024)
+    print(f"{action} {count} files ({megabytes:.2f} MB) in {elapsed:.2f}s: "
+          f"{count / elapsed:.1f} objects/s, {megabytes / elapsed:.2f} MB/s")
+
+
+def download_objects(s3_client, objects, local_folder, workers, on_downloaded=None):
+    # Bound the number of queued downloads so the listing generator is only
+    # consumed as fast as the pool drains it
+    def download_object(obj):
+        local_file_path = os.path.join(local_folder, obj['Key'].split("/")[-1])
+        s3_client.download_file(bucket_name, obj['Key'], local_file_path)
+        print(f"File {obj['Key']} downloaded to {local_file_path}")
+        return obj
+
+    start_time = time.time()
+    count = 0
+    total_bytes = 0
+
+    def finished(future):
+        nonlocal count, total_bytes
+        obj = future.result()
+        count += 1
+        total_bytes += obj['Size']
+        if on_downloaded is not None:
+            on_downloaded(obj)
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for obj in objects:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future)
+            pending.add(executor.submit(download_object, obj))
+        for future in as_completed(pending):
+            finished(future)
+
+    report_throughput("Downloaded", count, total_bytes, time.time() - start_time)
+
+
+def manifest_path(local_folder):
+    # Kept next to (not inside) the folder so os.listdir() only sees data files
+    return f".{local_folder}.manifest.json"
+
+
+def load_manifest(local_folder):
+    path = manifest_path(local_folder)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(local_folder, manifest):
+    path = manifest_path(local_folder)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def sync_objects(s3_client, objects, local_folder, workers):
+    # Mirror the listed objects into local_folder, fetching only keys whose
+    # ETag, size or last-modified changed since the previous sync
+    manifest = load_manifest(local_folder)
+    synced = {}
+    remote_files = set()
+
+    def entry(obj):
+        return {
+            'key': obj['Key'],
+            'etag': obj['ETag'],
+            'size': obj['Size'],
+            'last_modified': obj['LastModified'].isoformat(),
+        }
+
+    def changed_objects():
+        for obj in objects:
+            file_name = obj['Key'].split("/")[-1]
+            remote_files.add(file_name)
+            if manifest.get(file_name) == entry(obj) and os.path.exists(os.path.join(local_folder, file_name)):
+                synced[file_name] = manifest[file_name]
+            else:
+                yield obj
+
+    def on_downloaded(obj):
+        synced[obj['Key'].split("/")[-1]] = entry(obj)
+
+    try:
+        download_objects(s3_client, changed_objects(), local_folder, workers, on_downloaded)
+    finally:
+        save_manifest(local_folder, synced)
+
+    # Remove local files whose keys no longer exist in the bucket
+    for file_name in os.listdir(local_folder):
+        if file_name not in remote_files:
+            os.remove(os.path.join(local_folder, file_name))
+            print(f"File {file_name} removed from {local_folder}")
+
+
+def local_etag(file_path, part_size):
+    # S3 reports the MD5 of the body as the ETag of a single-part upload, and the
+    # MD5 of the concatenated part digests plus "-<parts>" for a multipart one
+    part_digests = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(part_size), b''):
+            part_digests.append(hashlib.md5(chunk).digest())
+
+    if os.path.getsize(file_path) < part_size:
+        return part_digests[0].hex() if part_digests else hashlib.md5(b'').hexdigest()
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f"-{len(part_digests)}"
+
+
+def transfer_config(part_size, max_concurrency):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=max_concurrency,
+    )
+
+
+def upload_files(s3_client, local_folder, s3_folder, workers, part_size, max_concurrency):
+    config = transfer_config(part_size, max_concurrency)
+
+    # One listing pass gives the ETag of every object already in the bucket
+    remote_etags = {obj['Key']: obj['ETag'].strip('"') for obj in list_objects(s3_client, s3_folder + "/")}
+
+    def upload_file(file_name):
+        file_path = os.path.join(local_folder, file_name)
+        object_name = f'{s3_folder}/{file_name}'  # The name of the file in the bucket, including the folder
+
+        if remote_etags.get(object_name) == local_etag(file_path, part_size):
+            return None
+
+        # Upload the file
+        s3_client.upload_file(file_path, bucket_name, object_name, Config=config)
+        print(f"File {file_path} uploaded to {bucket_name}/{object_name}")
+        return os.path.getsize(file_path)
+
+    start_time = time.time()
+    count = 0
+    skipped = 0
+    total_bytes = 0
+    # Temporary files of a run that stopped mid-write are not outputs
+    file_names = [file_name for file_name in os.listdir(local_folder) if not file_name.endswith(".tmp")]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size in executor.map(upload_file, file_names):
+            if size is None:
+                skipped += 1
+            else:
+                count += 1
+                total_bytes += size
+
+    report_throughput("Uploaded", count, total_bytes, time.time() - start_time)
+    print(f"Skipped {skipped} unchanged files")
+
+
+def download(workers=WORKERS):
+    print("download")
+
+    makedirs()
+    
+    s3_client = get_client('s3')
+
+    # List files in the specified folder
+    folder_name = 'text_paragraphs/'  # Replace with your folder name in S3
+    blobs = (obj for obj in list_objects(s3_client, folder_name)
+             if not obj['Key'].endswith("/"))
+
+    sync_objects(s3_client, blobs, text_paragraphs, workers)
+
+
+
+class TranslationCache:
+    # Translated sentences keyed by a hash of the translator and the sentence, one file
+    # per key. The file mtime doubles as the last-used time for LRU eviction
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.characters = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.folder, key + ".txt")
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)
+            return text
+        except OSError:
+            return None
+
+    def lookup(self, key, characters):
+        # characters is the length of the sentence, counted as saved on a hit
+        text = self.get(key)
+        with self.lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.characters += characters
+        return text
+
+    def put(self, key, text):
+        # Threads storing the same sentence at once each write their own temporary file
+        path = os.path.join(self.folder, key + ".txt")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.folder):
+            stat = os.stat(os.path.join(self.folder, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        # Drop least recently used entries until the cache fits
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.folder, file_name))
+            total_bytes -= size
+
+    def report(self):
+        total = max(self.hits + self.misses, 1)
+        print(f"Translation cache: {self.hits} hits, {self.misses} misses ({100 * self.hits / total:.0f}% hit rate), "
+              f"{self.characters} characters not sent")
+
+
+# Set from the CLI in main(), None disables caching
+translation_cache = None
+
+
+def make_cache(backend, max_mb):
+    if backend == "local":
+        return TranslationCache(cache_folder, max_mb * 1024 * 1024)
+    return None
+
+
+def normalize_text(text):
+    # Unicode forms and whitespace don't change the translation
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(translator_name, sentence):
+    request = {"translator": translator_name, "text": normalize_text(sentence)}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AWSTranslator:
+    # One Amazon Translate request per batch, the sentences joined by line breaks that
+    # the service keeps in place, on a pool of concurrency threads
+    def __init__(self, concurrency, source_language=SOURCE_LANGUAGE, target_language=TARGET_LANGUAGE):
+        self.name = f"aws:{source_language}-{target_language}"
+        self.workers = concurrency
+        self.max_sentences = None
+        self.max_chars = None
+        self.source_language = source_language
+        self.target_language = target_language
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def request(self, text):
+        with self.lock:
+            self.requests += 1
+        response = get_client('translate', region_name='us-east-1').translate_text(
+            Text=text,
+            SourceLanguageCode=self.source_language,
+            TargetLanguageCode=self.target_language,
+        )
+        return response["TranslatedText"]
+
+    def translate_batch(self, sentences):
+        lines = self.request("\n".join(sentences)).split("\n")
+        if len(lines) != len(sentences):
+            # The line breaks didn't survive, send the sentences of this batch one by one
+            print(f"Batch of {len(sentences)} sentences came back as {len(lines)} lines, retrying one by one")
+            return [self.request(sentence) for sentence in sentences]
+        return lines
+
+
+@lru_cache(maxsize=None)
+def load_marian(model_name):
+    # Loaded once per process and kept warm for every batch after the first
+    from transformers import MarianMTModel, MarianTokenizer
+
+    print(f"Loading {model_name}")
+    tokenizer = MarianTokenizer.from_pretrained(model_name)
+    model = MarianMTModel.from_pretrained(model_name).eval()
+    return tokenizer, model
+
+
+class MarianTranslator:
+    # Batches of up to batch_size sentences in one forward pass of a local MarianMT
+    # model, one batch at a time since the model already uses every core
+    def __init__(self, batch_size, source_language=SOURCE_LANGUAGE, target_language=TARGET_LANGUAGE):
+        self.model_name = MARIAN_MODEL or f"Helsinki-NLP/opus-mt-{source_language}-{target_language}"
+        self.name = f"marian:{self.model_name}"
+        self.workers = 1
+        self.max_sentences = batch_size
+        self.max_chars = MARIAN_MAX_CHARS
+        self.requests = 0
+
+    def translate_batch(self, sentences):
+        import torch
+
+        tokenizer, model = load_marian(self.model_name)
+        self.requests += 1
+        inputs = tokenizer(sentences, return_tensors="pt", padding=True, truncation=True)
+        with torch.inference_mode():
+            ids = model.generate(**inputs)
+        return [text.strip() for text in tokenizer.batch_decode(ids, skip_special_tokens=True)]
+
+
+class PseudoTranslator:
+    # Offline stand-in that accents the vowels of every sentence, so the stage, the
+    # batching and the cache can be exercised without credentials or a model
+    table = str.maketrans("aeiouAEIOU", "àéîõüÀÉÎÕÜ")
+
+    def __init__(self, source_language=SOURCE_LANGUAGE, target_language=TARGET_LANGUAGE):
+        self.name = f"pseudo:{source_language}-{target_language}"
+        self.workers = 1
+        self.max_sentences = None
+        self.max_chars = None
+        self.requests = 0
+
+    def translate_batch(self, sentences):
+        self.requests += 1
+        return [sentence.translate(self.table) for sentence in sentences]
+
+
+def make_translator(backend=TRANSLATOR, concurrency=CONCURRENCY, batch_size=BATCH_SIZE,
+                    source_language=SOURCE_LANGUAGE, target_language=TARGET_LANGUAGE):
+    if backend == "marian":
+        return MarianTranslator(batch_size, source_language, target_language)
+    if backend == "pseudo":
+        return PseudoTranslator(source_language, target_language)
+    return AWSTranslator(concurrency, source_language, target_language)
+
+
+def split_sentences(parts, max_chars):
+    # Cut sentences longer than max_chars between words, a single longer word where it
+    # reaches the limit. parts and the result are laid out as sentence_break.split
+    # returns them, sentences at even positions and the separators between them at odd ones
+    result = []
+    for i, part in enumerate(parts):
+        while i % 2 == 0 and len(part) > max_chars:
+            gaps = list(word_break.finditer(part, 1, max_chars + 1))
+            if gaps:
+                result += [part[:gaps[-1].start()], gaps[-1].group()]
+                part = part[gaps[-1].end():]
+            else:
+                result += [part[:max_chars], ""]
+                part = part[max_chars:]
+        result.append(part)
+    return result
+
+
+def pack_batches(sentences, max_chars=BATCH_CHARS, max_sentences=None):
+    # Group consecutive sentences into batches of at most max_chars characters
+    batch = []
+    chars = 0
+    for sentence in sentences:
+        if batch and (chars + len(sentence) > max_chars or len(batch) == max_sentences):
+            yield batch
+            batch = []
+            chars = 0
+        batch.append(sentence)
+        chars += len(sentence) + 1
+    if batch:
+        yield batch
+
+
+def translate_texts(texts, translator, batch_chars=BATCH_CHARS):
+    # Translate paragraphs sentence by sentence. Each distinct sentence is looked up in
+    # the cache once, the rest are packed into batches run on the translator's workers.
+    # Returns the translations and the number of characters sent to the translator.
+    # A sentence that wouldn't fit one request on its own is cut into pieces first
+    max_chars = min(batch_chars, translator.max_chars or batch_chars)
+    parts = [split_sentences(sentence_break.split(text), max_chars) for text in texts]
+
+    translations = {}
+    misses = []
+    for text_parts in parts:
+        # Sentences are at even positions, the separators between them at odd ones
+        for sentence in text_parts[::2]:
+            if not sentence.strip() or sentence in translations:
+                continue
+            translations[sentence] = None
+            if translation_cache is not None:
+                cached = translation_cache.lookup(cache_key(translator.name, sentence), len(sentence))
+                if cached is not None:
+                    translations[sentence] = cached
+                    continue
+            misses.append(sentence)
+
+    batches = list(pack_batches(misses, batch_chars, translator.max_sentences))
+    with ThreadPoolExecutor(max_workers=translator.workers) as executor:
+        for batch, results in zip(batches, executor.map(translator.translate_batch, batches)):
+            for sentence, translation in zip(batch, results):
+                translations[sentence] = translation
+                if translation_cache is not None:
+                    translation_cache.put(cache_key(translator.name, sentence), translation)
+
+    translated = []
+    for text_parts in parts:
+        translated.append("".join(translations[part] if i % 2 == 0 and part.strip() else part
+                                  for i, part in enumerate(text_parts)))
+    return translated, sum(len(sentence) for sentence in misses)
+
+
+def report_translation(translator, count, characters, sent, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    print(f"Translated {count} paragraphs ({characters} characters) with {translator.name} in {elapsed:.2f}s: "
+          f"{characters / elapsed:.0f} characters/s, {sent} characters sent in {translator.requests} requests")
+
+
+def write_text(text_file, text):
+    # Write to a temporary file and rename so a killed run never leaves a partial translation
+    with open(text_file + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(text_file + ".tmp", text_file)
+
+
+def translate(backend=TRANSLATOR, concurrency=CONCURRENCY, batch_chars=BATCH_CHARS, batch_size=BATCH_SIZE,
+              target_language=TARGET_LANGUAGE):
+    print("translate")
+    makedirs()
+
+    # Paragraphs that don't have a translation yet
+    pending = [text_file for text_file in sorted(os.listdir(text_paragraphs))
+               if not os.path.exists(os.path.join(text_translated, text_file))]
+
+    translator = make_translator(backend, concurrency, batch_size, target_language=target_language)
+
+    start_time = time.time()
+    characters = 0
+    sent = 0
+    for i in range(0, len(pending), GROUP_SIZE):
+        group = pending[i:i + GROUP_SIZE]
+        texts = []
+        for text_file in group:
+            with open(os.path.join(text_paragraphs, text_file), encoding="utf-8") as f:
+                texts.append(f.read())
+
+        translated, group_sent = translate_texts(texts, translator, batch_chars)
+        for text_file, text in zip(group, translated):
+            # Save the translation
+            write_text(os.path.join(text_translated, text_file), text)
+            print(f"Translation of {text_file} written to {text_translated}")
+        characters += sum(len(text) for text in texts)
+        sent += group_sent
+
+    report_translation(translator, len(pending), characters, sent, time.time() - start_time)
+
+    if translation_cache is not None:
+        translation_cache.report()
+        translation_cache.evict()
+
+
+def stream(backend=TRANSLATOR, concurrency=CONCURRENCY, batch_chars=BATCH_CHARS, batch_size=BATCH_SIZE,
+           target_language=TARGET_LANGUAGE):
+    # Read paragraphs straight from S3 and write translations straight back, no local folders
+    print("stream")
+
+    s3_client = get_client('s3')
+    translator = make_translator(backend, concurrency, batch_size, target_language=target_language)
+
+    # Paragraphs that already have a translation in the bucket are skipped
+    done = {obj['Key'].split("/")[-1] for obj in list_objects(s3_client, text_translated + "/")}
+    pending = [obj['Key'] for obj in list_objects(s3_client, text_paragraphs + "/")
+               if obj['Key'].endswith(".txt") and obj['Key'].split("/")[-1] not in done]
+
+    def read_object(key):
+        return s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read().decode("utf-8")
+
+    def write_object(key, text):
+        object_name = f"{text_translated}/{key.split('/')[-1]}"
+        s3_client.put_object(Bucket=bucket_name, Key=object_name, Body=text.encode("utf-8"))
+        print(f"Translation of {key} uploaded to {bucket_name}/{object_name}")
+
+    start_time = time.time()
+    characters = 0
+    sent = 0
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for i in range(0, len(pending), GROUP_SIZE):
+            group = pending[i:i + GROUP_SIZE]
+            texts = list(executor.map(read_object, group))
+            translated, group_sent = translate_texts(texts, translator, batch_chars)
+            list(executor.map(write_object, group, translated))
+            characters += sum(len(text) for text in texts)
+            sent += group_sent
+
+    report_translation(translator, len(pending), characters, sent, time.time() - start_time)
+
+    if translation_cache is not None:
+        translation_cache.report()
+        translation_cache.evict()
+
+
+def upload(workers=WORKERS, part_size=PART_SIZE, max_concurrency=MAX_CONCURRENCY):
+    print("upload")
+    makedirs()
+
+    s3_client = get_client('s3')
+
+    upload_files(s3_client, text_translated, text_translated, workers, part_size, max_concurrency)
+
+
+def main(args=None):
+    print("Args:", args)
+
+    global pool_connections, translation_cache
+    pool_connections = max(args.workers * args.max_concurrency, args.concurrency)
+    translation_cache = make_cache(args.cache, args.cache_max_mb)
+
+    options = dict(backend=args.translator, concurrency=args.concurrency, batch_chars=args.batch_chars,
+                   batch_size=args.batch_size, target_language=args.target_language)
+    if args.stream:
+        stream(**options)
+    if args.download:
+        download(workers=args.workers)
+    if args.translate:
+        translate(**options)
+    if args.upload:
+        upload(workers=args.workers, part_size=args.part_size * 1024 * 1024, max_concurrency=args.max_concurrency)
+
+
+if __name__ == "__main__":
+    # Generate the inputs arguments parser
+    # if you type into the terminal 'python cli.py --help', it will provide the description
+    parser = argparse.ArgumentParser(description="Translate English text")
+
+    parser.add_argument(
+        "-d",
+        "--download",
+        action="store_true",
+        help="Download paragraph of text from AWS",
+    )
+
+    parser.add_argument(
+        "-t", "--translate", action="store_true", help="Translate text"
+    )
+
+    parser.add_argument(
+        "-u", "--upload", action="store_true", help="Upload translated text to AWS"
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of concurrent S3 transfers",
+    )
+
+    parser.add_argument(
+        "--part-size",
+        type=int,
+        default=PART_SIZE // (1024 * 1024),
+        help="Multipart upload part size in MB",
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help="Number of concurrent part uploads per file",
+    )
+
+    parser.add_argument(
+        "--translator",
+        choices=TRANSLATORS,
+        default=TRANSLATOR,
+        help="Translation backend, marian runs locally on the CPU and pseudo is an offline stand-in for testing",
+    )
+
+    parser.add_argument(
+        "--target-language",
+        default=TARGET_LANGUAGE,
+        help="Language code to translate into",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help="Most concurrent translation requests",
+    )
+
+    parser.add_argument(
+        "--batch-chars",
+        type=int,
+        default=BATCH_CHARS,
+        help="Most characters of sentences packed into one translation request",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="Sentences per forward pass of the local model",
+    )
+
+    parser.add_argument(
+        "--cache",
+        choices=["local", "off"],
+        default="local",
+        help="Reuse translations of sentences that were translated before",
+    )
+
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=CACHE_MAX_MB,
+        help="Size limit of the translation cache in MB",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream inputs from S3 through the stage and back to S3 without local files",
+    )
+
+    args = parser.parse_args()
+
+    main(args)